@@ -0,0 +1,54 @@
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+
+from benchmarks import handlers, store
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the store and handler benchmarks and writes one JSON report."
+    )
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--sessions-per-user", type=int, default=1)
+    parser.add_argument("--roles-per-user", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=1_000)
+    parser.add_argument("--output", help="Writes the report here instead of stdout")
+    args = parser.parse_args()
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+    }
+    report["store"] = store.run(
+        args.users, args.sessions_per_user, args.roles_per_user, runs=args.runs
+    )
+    report["handlers"] = handlers.run(
+        args.users, args.sessions_per_user, args.roles_per_user, runs=args.runs
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import json
+import random
+import time
+
+from benchmarks.synthetic import generate_store
+from whistle_autocomplete import AUTOCOMPLETE_LIMIT
+from whistle_store import Whitelist
+
+
+def measure(users: int, lookups: int) -> dict:
+    white_list = Whitelist(generate_store(users, sessions_per_user=0)["whitelist"])
+    usernames = list(white_list.get_users().keys())
+    rng = random.Random(0)
+    prefixes = [rng.choice(usernames)[: rng.randrange(0, 9)] for _ in range(lookups)]
+    timings = []
+    for prefix in prefixes:
+        started = time.perf_counter()
+        white_list.find_usernames(prefix, AUTOCOMPLETE_LIMIT)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "users": users,
+        "lookups": lookups,
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 2),
+        "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 2),
+        "max_us": round(timings[-1] * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures username autocomplete lookups against the prefix index."
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--lookups", type=int, default=10_000)
+    args = parser.parse_args()
+    print(json.dumps([measure(users, args.lookups) for users in args.users], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+from typing import Dict, List
+
+from whistle_actions import wlActionQueues
+from whistle_audit import wlAuditLog
+from whistle_expiry import wlSessionExpiry
+from whistle_store import wlStores
+
+# Network-free stand-ins for the parts of discord.py the cogs touch
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.mention = f"<@&{role_id}>"
+
+    def is_default(self) -> bool:
+        return False
+
+
+class FakeMember:
+    def __init__(self, member_id: int, guild: "FakeGuild"):
+        self.id = member_id
+        self.guild = guild
+        self.nick = None
+        self.roles = []
+        self.mention = f"<@{member_id}>"
+
+    async def edit(self, **changes):
+        if "nick" in changes:
+            self.nick = changes["nick"]
+        if "roles" in changes:
+            self.roles = list(changes["roles"])
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.members: Dict[int, FakeMember] = {}
+        self.roles: Dict[int, FakeRole] = {}
+
+    def get_member(self, member_id: int) -> FakeMember:
+        member = self.members.get(member_id, None)
+        if member is None:
+            member = self.members[member_id] = FakeMember(member_id, self)
+        return member
+
+    async def fetch_member(self, member_id: int) -> FakeMember:
+        return self.get_member(member_id)
+
+    def get_role(self, role_id: int) -> FakeRole:
+        role = self.roles.get(role_id, None)
+        if role is None:
+            role = self.roles[role_id] = FakeRole(role_id)
+        return role
+
+
+class FakeMessage:
+    def __init__(self, content: str | None):
+        self.content = content
+
+    async def edit(self, content: str | None = None, **kwargs):
+        self.content = content
+
+
+class FakeAttachment:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.__data = data
+
+    async def read(self) -> bytes:
+        return self.__data
+
+
+class FakeBot:
+    def __init__(self, directory: str, backend: str = "json"):
+        self.wl_brand = "Whistle"
+        self.wl_stores = wlStores(directory, backend)
+        self.wl_actions = wlActionQueues(self)
+        self.wl_expiry = wlSessionExpiry(self.wl_stores, 0, lambda *args: None)
+        self.wl_stores.on_load.append(self.wl_expiry.attach)
+        self.wl_audit = wlAuditLog(os.path.join(directory, "audit"))
+        self.guilds: Dict[int, FakeGuild] = {}
+
+    def get_guild(self, guild_id: int) -> FakeGuild | None:
+        return self.guilds.get(guild_id, None)
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot, guild: FakeGuild, author: FakeMember):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        bot.guilds[guild.id] = guild
+        self.interaction = None
+        self.invoked_subcommand = None
+        self.replies: List[dict] = []
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def reply(self, content: str | None = None, **kwargs) -> FakeMessage:
+        self.replies.append(dict(kwargs, content=content))
+        return FakeMessage(content)
+
+    async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+        return await self.reply(content, **kwargs)
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+
+from benchmarks.fakes import FakeAttachment, FakeBot, FakeContext, FakeGuild
+from benchmarks.synthetic import generate_store
+from benchmarks.timing import measure_async
+from modules.admin import Administration
+from modules.session import User
+from whistle_backend import wlSnapshotBackend, wlSqliteBackend
+
+GUILD_ID = 1
+
+
+def seed_store(
+    bot: FakeBot, backend: str, users: int, sessions_per_user: int, roles_per_user: int
+):
+    data = generate_store(users, sessions_per_user, roles_per_user)
+    data["whitelist"]["benchuser"] = {
+        "pretty": "Bench User",
+        "session_limit": 1,
+        "sessions": [],
+        "roles": [],
+    }
+    path = bot.wl_stores.path(GUILD_ID)
+    if backend == "sqlite":
+        sqlite = wlSqliteBackend(path)
+        sqlite.replace_all(data)
+        sqlite.close()
+    else:
+        wlSnapshotBackend.save_store(path, data, backend)
+
+
+async def measure_handlers(
+    users: int,
+    sessions_per_user: int,
+    roles_per_user: int,
+    backend: str,
+    directory: str,
+    runs: int,
+) -> dict:
+    bot = FakeBot(directory, backend)
+    seed_store(bot, backend, users, sessions_per_user, roles_per_user)
+    guild = FakeGuild(GUILD_ID)
+    author = guild.get_member(10**15)
+    target = guild.get_member(10**15 + 1)
+    role = guild.get_role(10**15 + 2)
+    ctx = FakeContext(bot, guild, author)
+    user_cog = User(bot)
+    admin_cog = Administration(bot)
+    # The first use of the guild loads its store, every other call finds it
+    results = {
+        "first_whois": await measure_async(
+            User.session_whois.callback, 1, user_cog, ctx, "benchuser"
+        )
+    }
+
+    async def login_logout():
+        await User.session_set.callback(user_cog, ctx, "benchuser")
+        await User.session_clear.callback(user_cog, ctx)
+
+    async def loginctl_evict():
+        await Administration.session_force_set.callback(
+            admin_cog, ctx, target, "benchuser"
+        )
+        await Administration.session_term.callback(admin_cog, ctx, target)
+
+    async def add_remove():
+        await Administration.whitelist_add.callback(
+            admin_cog, ctx, "Bench Added", None, 1, None
+        )
+        await Administration.whitelist_remove.callback(admin_cog, ctx, "benchadded")
+
+    async def link_unlink():
+        await Administration.roles_link.callback(admin_cog, ctx, "benchuser", role)
+        await Administration.roles_unlink.callback(admin_cog, ctx, "benchuser", role)
+
+    import_file = FakeAttachment(
+        "bench.jsonl",
+        b"".join(
+            json.dumps({"username": f"imported{index}", "session_limit": 1}).encode()
+            + b"\n"
+            for index in range(100)
+        ),
+    )
+    results["whois"] = await measure_async(
+        User.session_whois.callback, runs, user_cog, ctx, "benchuser"
+    )
+    results["login_logout"] = await measure_async(login_logout, runs)
+    results["loginctl_evict"] = await measure_async(loginctl_evict, runs)
+    results["whitelist_add_remove"] = await measure_async(add_remove, runs)
+    results["roles_link_unlink"] = await measure_async(link_unlink, runs)
+    results["whitelist_list"] = await measure_async(
+        Administration.whitelist_list.callback, runs, admin_cog, ctx, "user", "name", 3
+    )
+    results["whitelist_list_by_sessions"] = await measure_async(
+        Administration.whitelist_list.callback,
+        runs,
+        admin_cog,
+        ctx,
+        "",
+        "sessions",
+        1,
+    )
+    results["whitelist_import_dry_run_100"] = await measure_async(
+        Administration.whitelist_import.callback,
+        max(1, runs // 10),
+        admin_cog,
+        ctx,
+        import_file,
+        True,
+        False,
+    )
+    results["whitelist_export_jsonl"] = await measure_async(
+        Administration.whitelist_export.callback, 3, admin_cog, ctx, "jsonl"
+    )
+    results["data_save"] = await measure_async(
+        Administration.data_store_save.callback, 3, admin_cog, ctx
+    )
+    # The nick and role edits the handlers queued are not part of the timings.
+    # An empty action resolves once everything queued before it for the member
+    # was applied, so the queue is drained before the store is unloaded.
+    drained = []
+    for member in (author, target):
+        done = asyncio.get_running_loop().create_future()
+        bot.wl_actions.enqueue(guild, member.id, done=done)
+        drained.append(done)
+    await asyncio.gather(*drained)
+    await bot.wl_stores.unload_all()
+    return results
+
+
+def run(
+    users: int = 100_000,
+    sessions_per_user: int = 1,
+    roles_per_user: int = 2,
+    backends=("json", "sqlite"),
+    runs: int = 1_000,
+) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in backends:
+            backend_directory = os.path.join(directory, backend)
+            results[backend] = asyncio.run(
+                measure_handlers(
+                    users,
+                    sessions_per_user,
+                    roles_per_user,
+                    backend,
+                    backend_directory,
+                    runs,
+                )
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the cog command handlers against a fake guild."
+    )
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--sessions-per-user", type=int, default=1)
+    parser.add_argument("--roles-per-user", type=int, default=2)
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    parser.add_argument("--runs", type=int, default=1_000)
+    args = parser.parse_args()
+    results = run(
+        args.users,
+        args.sessions_per_user,
+        args.roles_per_user,
+        args.backends,
+        args.runs,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_store
+from benchmarks.timing import measure, summarize
+from whistle_backend import wlSnapshotBackend
+from whistle_store import wlStore
+
+
+async def measure_saves(
+    users: int, snapshot_format: str, directory: str, changes: int, runs: int
+) -> dict:
+    file_path = os.path.join(directory, f"store-{users}.{snapshot_format}")
+    wlSnapshotBackend.save_store(file_path, generate_store(users), snapshot_format)
+    store = wlStore(file_path, snapshot_format)
+    white_list = store.get_whitelist()
+    usernames = list(white_list.get_users().keys())
+    rng = random.Random(0)
+
+    def change():
+        for username in rng.sample(usernames, changes):
+            user = white_list.get_user(username)
+            user.pretty = user.pretty + "!"
+
+    # The first save after a load encodes every user
+    change()
+    started = time.perf_counter()
+    await store.save_async()
+    first_save = time.perf_counter() - started
+    timings = []
+    for run in range(runs):
+        change()
+        started = time.perf_counter()
+        await store.save_async()
+        timings.append(time.perf_counter() - started)
+    # What every save cost before: the whole whitelist encoded again
+    full_encode = measure(
+        lambda: wlSnapshotBackend.encode(store.jsonify(), snapshot_format),
+        max(1, runs // 4),
+    )
+    await store.close()
+    return {
+        "users": users,
+        "format": snapshot_format,
+        "changes_per_save": changes,
+        "first_save_us": round(first_save * 1e6, 2),
+        "incremental_save": summarize(timings),
+        "full_encode": full_encode,
+        "size_bytes": os.path.getsize(file_path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times saves that only encode the users changed since the last one."
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--changes", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for users in args.users:
+            for snapshot_format in ("json", "msgpack"):
+                results.append(
+                    asyncio.run(
+                        measure_saves(
+                            users, snapshot_format, directory, args.changes, args.runs
+                        )
+                    )
+                )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import gc
+import json
+import tracemalloc
+
+from benchmarks.synthetic import generate_store
+from whistle_store import Whitelist
+
+
+def measure(users: int) -> dict:
+    # Counts what a loaded whitelist keeps alive, starting from the encoded
+    # store so usernames and ids are allocated while tracing.
+    encoded = json.dumps(generate_store(users)["whitelist"])
+    gc.collect()
+    tracemalloc.start()
+    data = json.loads(encoded)
+    white_list = Whitelist(data)
+    del data
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(white_list.get_users()) == users
+    return {
+        "users": users,
+        "retained_bytes": retained,
+        "bytes_per_user": round(retained / users, 1),
+        "peak_bytes": peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the memory a loaded whitelist retains per user."
+    )
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+    print(json.dumps([measure(users) for users in args.users], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_store
+from whistle_backend import wlSnapshotBackend
+from whistle_store import wlStore
+
+
+def measure(users: int, snapshot_format: str, directory: str) -> dict:
+    data = generate_store(users)
+    file_path = os.path.join(directory, f"store-{users}.{snapshot_format}")
+    started = time.perf_counter()
+    wlSnapshotBackend.save_store(file_path, data, snapshot_format)
+    save_time = time.perf_counter() - started
+    started = time.perf_counter()
+    store = wlStore(file_path, snapshot_format)
+    load_time = time.perf_counter() - started
+    assert len(store.get_whitelist().get_users()) == users
+    return {
+        "users": users,
+        "format": snapshot_format,
+        "save_seconds": round(save_time, 4),
+        "load_seconds": round(load_time, 4),
+        "size_bytes": os.path.getsize(file_path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares store load/save time and size for JSON and msgpack."
+    )
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for users in args.users:
+            for snapshot_format in ("json", "msgpack"):
+                results.append(measure(users, snapshot_format, directory))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
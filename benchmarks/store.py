@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+
+from benchmarks.synthetic import generate_store
+from benchmarks.timing import measure, measure_async
+from whistle_backend import BACKEND_EXTENSIONS, wlSnapshotBackend, wlSqliteBackend
+from whistle_store import Whitelist, wlStore
+
+
+def whitelist_operations(
+    users: int, sessions_per_user: int, roles_per_user: int, runs: int
+) -> dict:
+    data = generate_store(users, sessions_per_user, roles_per_user)
+    white_list = Whitelist(data["whitelist"])
+    rng = random.Random(0)
+    usernames = list(white_list.get_users().keys())
+    sessions = [
+        session_id
+        for user in white_list.get_users().values()
+        for session_id in user.list_sessions()
+    ]
+    missing = iter(range(10**12, 10**12 + runs * 2))
+    results = {
+        "get_session_hit": measure(
+            lambda: white_list.get_session(rng.choice(sessions)), runs
+        )
+        if sessions
+        else None,
+        "get_session_miss": measure(
+            lambda: white_list.get_session(next(missing)), runs
+        ),
+        "get_user": measure(lambda: white_list.get_user(rng.choice(usernames)), runs),
+        "find_usernames": measure(
+            lambda: white_list.find_usernames(rng.choice(usernames)[:6], 25), runs
+        ),
+        "page_usernames_by_sessions": measure(
+            lambda: white_list.page_usernames(
+                rng.randrange(users), 20, by_sessions=True
+            ),
+            runs,
+        ),
+    }
+    # Misses with the first letter dropped, once the trigram index is built
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(white_list.index_trigrams())
+    results["suggest_usernames"] = measure(
+        lambda: loop.run_until_complete(
+            white_list.suggest_usernames(rng.choice(usernames)[1:], 3)
+        ),
+        runs,
+    )
+    loop.close()
+    added = iter(range(runs))
+    results["add_user"] = measure(
+        lambda: white_list.add_user(
+            f"bench{next(added):07d}", "Bench", 2, [], []
+        ),
+        runs,
+    )
+    removed = iter(range(runs))
+    results["remove_user"] = measure(
+        lambda: white_list.remove_user(f"bench{next(removed):07d}"), runs
+    )
+    login = iter(range(10**13, 10**13 + runs * 2))
+    user = white_list.get_user(usernames[0])
+    user.set_session_limit(runs + sessions_per_user)
+
+    def login_logout():
+        session_id = next(login)
+        user.create_session(session_id)
+        user.drop_session(session_id)
+
+    results["login_logout"] = measure(login_logout, runs)
+    # Changes copy the user's old state into every open snapshot
+    results["snapshot"] = measure(lambda: white_list.snapshot().close(), runs)
+    with white_list.snapshot() as snapshot:
+        results["login_logout_during_snapshot"] = measure(login_logout, runs)
+        results["snapshot_jsonify"] = measure(snapshot.jsonify, max(1, runs // 1000))
+    results["jsonify"] = measure(white_list.jsonify, max(1, runs // 1000))
+    return results
+
+
+def store_operations(
+    users: int,
+    sessions_per_user: int,
+    roles_per_user: int,
+    backend: str,
+    directory: str,
+    runs: int,
+) -> dict:
+    data = generate_store(users, sessions_per_user, roles_per_user)
+    file_path = os.path.join(directory, f"store-{users}{BACKEND_EXTENSIONS[backend]}")
+    if backend == "sqlite":
+        backend_store = wlSqliteBackend(file_path)
+        backend_store.replace_all(data)
+        backend_store.close()
+    else:
+        wlSnapshotBackend.save_store(file_path, data, backend)
+    stores = []
+    results = {"load": measure(lambda: stores.append(wlStore(file_path, backend)), 3)}
+    store = stores[-1]
+    white_list = store.get_whitelist()
+    user = white_list.get_user(next(iter(white_list.get_users())))
+    # The autosaver only checks is_dirty() on every tick, saves follow changes
+    results["is_dirty"] = measure(store.is_dirty, runs)
+
+    async def change_and_save():
+        user.pretty = user.pretty
+        await store.save_async()
+        await store.commit()
+
+    async def run() -> dict:
+        result = await measure_async(change_and_save, 5)
+        for loaded in stores:
+            await loaded.close()
+        return result
+
+    results["save_after_change"] = asyncio.run(run())
+    results["size_bytes"] = os.path.getsize(file_path)
+    return results
+
+
+def run(
+    users: int = 100_000,
+    sessions_per_user: int = 1,
+    roles_per_user: int = 2,
+    backends=("json", "msgpack", "sqlite"),
+    runs: int = 10_000,
+) -> dict:
+    results = {
+        "whitelist": whitelist_operations(
+            users, sessions_per_user, roles_per_user, runs
+        ),
+        "backends": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in backends:
+            results["backends"][backend] = store_operations(
+                users, sessions_per_user, roles_per_user, backend, directory, runs
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times every whitelist and data store operation."
+    )
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--sessions-per-user", type=int, default=1)
+    parser.add_argument("--roles-per-user", type=int, default=2)
+    parser.add_argument(
+        "--backends", nargs="+", default=["json", "msgpack", "sqlite"]
+    )
+    parser.add_argument("--runs", type=int, default=10_000)
+    args = parser.parse_args()
+    results = run(
+        args.users,
+        args.sessions_per_user,
+        args.roles_per_user,
+        args.backends,
+        args.runs,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import random
+from typing import Dict
+
+
+def generate_store(
+    users: int,
+    sessions_per_user: int = 1,
+    roles_per_user: int = 2,
+    role_pool: int = 25,
+    seed: int = 0,
+) -> Dict:
+    # Member and role ids are 18 digit snowflakes like Discord's. Roles are
+    # drawn from a small pool, the way a guild links a handful of roles.
+    rng = random.Random(seed)
+    roles = [
+        rng.randrange(10**17, 10**18)
+        for _ in range(max(role_pool, roles_per_user))
+    ]
+    white_list = {}
+    for index in range(users):
+        username = f"user{index:07d}"
+        white_list[username] = {
+            "pretty": f"User {index}",
+            "session_limit": max(sessions_per_user, 1),
+            "sessions": [
+                rng.randrange(10**17, 10**18) for _ in range(sessions_per_user)
+            ],
+            "roles": rng.sample(roles, roles_per_user),
+        }
+    return {"revision": 0, "whitelist": white_list}
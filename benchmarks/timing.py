@@ -0,0 +1,31 @@
+import time
+from typing import Awaitable, Callable, List
+
+
+def summarize(timings: List[float]) -> dict:
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 2),
+        "p50_us": round(timings[len(timings) // 2] * 1e6, 2),
+        "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 2),
+        "max_us": round(timings[-1] * 1e6, 2),
+    }
+
+
+def measure(function: Callable, runs: int, *args) -> dict:
+    timings = []
+    for run in range(runs):
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+
+async def measure_async(function: Callable[..., Awaitable], runs: int, *args) -> dict:
+    timings = []
+    for run in range(runs):
+        started = time.perf_counter()
+        await function(*args)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
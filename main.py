@@ -1,70 +1,250 @@
 import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
 
 import discord
 from discord.ext import commands
 
-from whistle_config import wl_brand, wl_token
-from whistle_store import WLSTORE_FILENAME, wlStore
+from whistle_actions import PRIORITY_BACKGROUND, wlActionQueues
+from whistle_audit import wlAuditLog
+from whistle_config import (
+    wl_action_concurrency,
+    wl_audit_compression,
+    wl_audit_directory,
+    wl_audit_segment_size,
+    wl_audit_segments_kept,
+    wl_brand,
+    wl_command_hash_file,
+    wl_log_level,
+    wl_lookup_host,
+    wl_lookup_port,
+    wl_lookup_socket,
+    wl_metrics_host,
+    wl_metrics_port,
+    wl_session_ttl,
+    wl_store_backend,
+    wl_store_directory,
+    wl_store_file,
+    wl_store_idle_timeout,
+    wl_store_legacy_guild,
+    wl_token,
+)
+from whistle_expiry import wlSessionExpiry
+from whistle_logging import setup_logging
+from whistle_lookup import wlLookupServer
+from whistle_metrics import (
+    COMMAND_BUCKETS,
+    SAVE_BUCKETS,
+    instrument_http,
+    metrics,
+    route_trace,
+    wlMetricsServer,
+)
+from whistle_store import User, wlStores
+
+log = logging.getLogger(__name__)
 
 
 class wlBot(commands.Bot):
     wl_version: str = "v1.0.0"
     wl_brand: str = wl_brand
-    wl_store: wlStore
-    __wl_store_autosaver: asyncio.Task
+    wl_stores: wlStores
+    wl_actions: wlActionQueues
+    wl_expiry: wlSessionExpiry
+    wl_audit: wlAuditLog
+    __wl_stores_maintainer: asyncio.Task
+    __wl_expiry_scheduler: asyncio.Task
+    __wl_metrics_server: wlMetricsServer | None
+    __wl_lookup_server: wlLookupServer | None
+    __wl_started: float
 
     def __init__(
         self,
         command_prefix: str = ".",
         intents: discord.Intents = discord.Intents.all(),
     ):
-        super().__init__(command_prefix, intents=intents)
-        self.wl_store = wlStore(WLSTORE_FILENAME)
+        # The presence is sent with every identify, so reconnects keep it
+        super().__init__(
+            command_prefix,
+            intents=intents,
+            http_trace=route_trace(),
+            activity=discord.Activity(
+                type=discord.ActivityType.watching, name=f"the whitelist"
+            ),
+        )
+        instrument_http(self.http)
+        # Hooks run inside the invoke, events are dispatched as separate tasks
+        self.before_invoke(self.__command_started)
+        self.after_invoke(self.__command_finished)
+        self.__wl_started = time.perf_counter()
+        self.__wl_metrics_server = None
+        self.__wl_lookup_server = None
+        self.wl_stores = wlStores(
+            wl_store_directory,
+            wl_store_backend,
+            wl_store_file,
+            wl_store_legacy_guild or None,
+            wl_store_idle_timeout,
+        )
+        self.wl_actions = wlActionQueues(self, wl_action_concurrency)
+        self.wl_expiry = wlSessionExpiry(
+            self.wl_stores, wl_session_ttl, self.__session_expired
+        )
+        self.wl_stores.on_load.append(self.wl_expiry.attach)
+        self.wl_audit = wlAuditLog(
+            wl_audit_directory,
+            wl_audit_segment_size,
+            wl_audit_segments_kept,
+            wl_audit_compression,
+        )
+
+    async def setup_hook(self):
+        # Runs once per login, unlike on_ready which fires on every reconnect
+        await self.__timed("Loading modules", self.load_modules())
+        # Run wlStores Maintainer, guild stores run their own autosavers
+        self.__wl_stores_maintainer = asyncio.get_running_loop().create_task(
+            self.wl_stores.maintainer(), name="wlStores Maintainer"
+        )
+        log.info("Running wlStores Maintainer...DONE!")
+        # One scheduler expires the sessions of every loaded store
+        self.__wl_expiry_scheduler = asyncio.get_running_loop().create_task(
+            self.wl_expiry.run(), name="Session Expiry"
+        )
+        log.info("Running Session Expiry...DONE!")
+        # Serve metrics on localhost when a port is configured
+        if wl_metrics_port:
+            self.__wl_metrics_server = wlMetricsServer(wl_metrics_host, wl_metrics_port)
+            await self.__timed(
+                "Starting metrics server", self.__wl_metrics_server.start()
+            )
+            log.info(
+                f"Serving metrics on http://{wl_metrics_host}:{wl_metrics_port}/metrics"
+            )
+        # Answer whitelist lookups for game servers when configured
+        if wl_lookup_socket or wl_lookup_port:
+            self.__wl_lookup_server = wlLookupServer(
+                self.wl_stores, wl_lookup_host, wl_lookup_port, wl_lookup_socket or None
+            )
+            await self.__timed(
+                "Starting lookup server", self.__wl_lookup_server.start()
+            )
+            where = wl_lookup_socket or f"http://{wl_lookup_host}:{wl_lookup_port}"
+            log.info(f"Serving whitelist lookups on {where}")
+        # Sync our command tree, but only if it changed since the last sync
+        await self.__timed("Syncing commands", self.sync_commands())
 
     async def on_ready(self):
         # Announce our user
-        print(f"Logged in as {self.user}")
-        # Run wlStore Auto Saver
-        print("Running wlStore Autosaver...", end="\r")
-        self.__wl_store_autosaver = asyncio.get_event_loop().create_task(
-            self.wl_store.autosaver(), name="wlStore Autosaver"
-        )
-        print("Running wlStore Autosaver...DONE!")
-        # Wait until we're ready
-        print("Waiting for client...", end="\r")
-        await self.wait_until_ready()
-        print("Waiting for client...DONE!")
-        # Sync our command tree
-        print("Syncing commands...", end="\r")
-        await self.tree.sync()
-        print("Syncing commands...DONE!")
-        # Set our presence status
-        print("Setting activity...", end="\r")
-        await self.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.watching, name=f"the whitelist"
+        log.info(f"Logged in as {self.user}")
+        log.info(f"Ready! ({(time.perf_counter() - self.__wl_started) * 1e3:.0f}ms)")
+
+    async def __timed(self, phase: str, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        duration = time.perf_counter() - started
+        metrics.histogram(
+            "whistle_startup_seconds",
+            "Startup phase duration",
+            SAVE_BUCKETS,
+            phase=phase,
+        ).observe(duration)
+        log.info(f"{phase}...DONE! ({duration * 1e3:.0f}ms)")
+        return result
+
+    def command_tree_hash(self) -> str:
+        # The payload tree.sync() would send, plus the application it goes to
+        payload = {
+            "application_id": self.application_id,
+            "commands": sorted(
+                (command.to_dict() for command in self.tree.get_commands()),
+                key=lambda command: (command.get("type", 1), command["name"]),
+            ),
+        }
+        encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    async def sync_commands(self) -> bool:
+        tree_hash = self.command_tree_hash()
+        try:
+            with open(wl_command_hash_file, "r") as file:
+                synced_hash = file.read().strip()
+        except FileNotFoundError:
+            synced_hash = None
+        if tree_hash == synced_hash:
+            log.info("Command tree unchanged since the last sync, skipping it")
+            return False
+        try:
+            await self.tree.sync()
+        except discord.HTTPException as e:
+            # Without a persisted hash the next start tries again
+            log.error(f"Syncing commands...ERROR\nCould not sync the command tree: {e}")
+            return False
+        temp_path = wl_command_hash_file + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(tree_hash + "\n")
+        os.replace(temp_path, wl_command_hash_file)
+        return True
+
+    def __session_expired(self, guild_id: int, member_id: int, user: User):
+        # The same nick and role cleanup as .logout
+        guild = self.get_guild(guild_id)
+        if guild is not None:
+            self.wl_actions.logout(
+                guild, member_id, user, priority=PRIORITY_BACKGROUND
             )
-        )
-        print("Setting activity...DONE!")
-        # Announce we're ready
-        print("Ready!")
+
+    async def __command_started(self, ctx: commands.Context):
+        ctx.wl_started = time.perf_counter()
+
+    async def __command_finished(self, ctx: commands.Context):
+        started = getattr(ctx, "wl_started", None)
+        if started is None or ctx.command is None:
+            return
+        if ctx.invoked_subcommand not in (None, ctx.command):
+            # The group's own callback, its subcommand is observed next
+            return
+        metrics.histogram(
+            "whistle_command_seconds",
+            "Command handler latency",
+            COMMAND_BUCKETS,
+            command=ctx.command.qualified_name,
+            status="error" if ctx.command_failed else "ok",
+        ).observe(time.perf_counter() - started)
+
+    async def close(self):
+        await self.wl_stores.unload_all()
+        await self.wl_audit.flush()
+        if self.__wl_metrics_server is not None:
+            await self.__wl_metrics_server.close()
+        if self.__wl_lookup_server is not None:
+            await self.__wl_lookup_server.close()
+        await super().close()
 
     async def load_modules(self):
-        modules = ["admin", "session"]
-        print("Loading modules, please wait.")
-        for i in modules:
-            print(f"Loading module {i}...", end="\r")
-            try:
-                await self.load_extension(f"modules.{i}")
-                print(f"Loading module {i}...OK")
-            except Exception as e:
-                print(
-                    f"Loading module {i}...ERROR\nCould not load module {i} because it raised an exception: {e}"
-                )
-        print("Modules loaded! Read above for more details.")
+        modules = ["admin", "members", "session"]
+        log.info("Loading modules, please wait.")
+        await asyncio.gather(*(self.__load_module(i) for i in modules))
+        log.info("Modules loaded! Read above for more details.")
+
+    async def __load_module(self, i: str):
+        started = time.perf_counter()
+        try:
+            await self.load_extension(f"modules.{i}")
+            log.info(
+                f"Loading module {i}...OK ({(time.perf_counter() - started) * 1e3:.0f}ms)"
+            )
+        except Exception as e:
+            log.error(
+                f"Loading module {i}...ERROR\nCould not load module {i} because it raised an exception: {e}"
+            )
 
 
+log_listener = setup_logging(wl_log_level)
 bot = wlBot()
 
-asyncio.run(bot.load_modules())
-bot.run(wl_token)
+# discord.py logs through the queue handler set up above
+bot.run(wl_token, log_handler=None)
+log_listener.stop()
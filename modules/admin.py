@@ -1,11 +1,244 @@
+import asyncio
+import io
+import re
+import time
+from typing import Dict, Iterable, List, Literal, Set, Tuple
+
 import discord
 from discord.ext import commands
 
+from whistle_actions import PRIORITY_BACKGROUND, UNCHANGED
+from whistle_autocomplete import username_autocomplete, username_not_found
+from whistle_bulk import detect_format, export_rows, parse_rows
+from whistle_metrics import metrics
+from whistle_store import (
+    AUTOSAVE_BYTES,
+    AUTOSAVE_SECONDS,
+    Whitelist,
+    normalize_username,
+    wlStore,
+)
+
+MEMBER_EDIT_PROGRESS_INTERVAL = 2.0
+IMPORT_ERRORS_SHOWN = 15
+BATCH_UNKNOWN_SHOWN = 15
+AUDIT_EVENTS_SHOWN = 15
+WHITELIST_PAGE_SIZE = 20
+STATS_ROWS_SHOWN = 8
+
+
+def format_histograms(name: str, label: str, scale: float, unit: str) -> str:
+    # One line per label value, busiest first
+    merged = {}
+    for labels, histogram in metrics.family(name).items():
+        merged.setdefault(dict(labels).get(label, ""), []).append(histogram)
+    rows = sorted(
+        merged.items(), key=lambda item: -sum(h.count for h in item[1])
+    )[:STATS_ROWS_SHOWN]
+    lines = []
+    for value, histograms in rows:
+        count = sum(h.count for h in histograms)
+        if not count:
+            continue
+        total = sum(h.sum for h in histograms)
+        worst = max(h.quantile(0.99) for h in histograms)
+        lines.append(
+            f"`{value or '-'}` {count}x, mean {total / count * scale:.1f}{unit}, p99 {worst * scale:.1f}{unit}"
+        )
+    return "\n".join(lines) or "No data yet"
+
+
+def parse_targets(
+    guild: discord.Guild, white_list: Whitelist, text: str
+) -> Tuple[Set[int], Set[str], List[str]]:
+    # Splits a list of member mentions or ids, role mentions and usernames
+    # into (member ids, usernames, unknown). A role stands for every member
+    # holding it.
+    member_ids = set()
+    usernames = set()
+    unknown = []
+    for token in text.replace(",", " ").split():
+        match = re.fullmatch(r"<@([!&]?)(\d+)>", token)
+        if match is not None and match.group(1) == "&":
+            role = guild.get_role(int(match.group(2)))
+            if role is None:
+                unknown.append(token)
+                continue
+            member_ids.update(member.id for member in role.members)
+        elif match is not None:
+            member_ids.add(int(match.group(2)))
+        elif token.isdigit() and (
+            guild.get_member(int(token)) is not None
+            or white_list.get_session(int(token)) is not None
+        ):
+            member_ids.add(int(token))
+        elif white_list.get_user(normalize_username(token)) is not None:
+            usernames.add(normalize_username(token))
+        else:
+            unknown.append(token)
+    return member_ids, usernames, unknown
+
+
+def format_batch_summary(done: str, results: Dict[str, int], notes: List[str]) -> str:
+    lines = [
+        done,
+        "Changed: {changed} | Skipped: {skipped} | Failed: {failed}".format(**results),
+    ]
+    lines.extend(note for note in notes if note)
+    return "\n".join(lines)
+
+
+def format_unknown(unknown: List[str]) -> str:
+    if not unknown:
+        return ""
+    shown = ", ".join(f"`{token}`" for token in unknown[:BATCH_UNKNOWN_SHOWN])
+    more = len(unknown) - BATCH_UNKNOWN_SHOWN
+    return f"Unknown: {shown}" + (f" and {more} more" if more > 0 else "")
+
+
+def format_audit_event(event: Dict) -> str:
+    line = f"<t:{event['time']}:R> <@{event['actor']}> `{event['action']}`"
+    if event.get("user") is not None:
+        line += f" {event['user']}"
+    if event.get("member") is not None:
+        line += f" <@{event['member']}>"
+    if event.get("role") is not None:
+        line += f" <@&{event['role']}>"
+    if "ttl" in event:
+        line += f" ({event['ttl']}s)" if event["ttl"] is not None else " (global)"
+    return line
+
+
+def format_counters(name: str, label: str) -> Dict[str, float]:
+    totals = {}
+    for labels, counter in metrics.family(name).items():
+        value = dict(labels).get(label, "")
+        totals[value] = totals.get(value, 0) + counter.value
+    return totals
+
+
+class WhitelistPages(discord.ui.View):
+    def __init__(
+        self,
+        bot: commands.Bot,
+        store: wlStore,
+        author: discord.abc.User,
+        prefix: str,
+        by_sessions: bool,
+        page: int = 0,
+    ):
+        super().__init__(timeout=180)
+        self.bot = bot
+        self.store = store
+        self.author = author
+        self.prefix = prefix
+        self.by_sessions = by_sessions
+        self.page = page
+
+    def render(self) -> discord.Embed:
+        white_list = self.store.get_whitelist()
+        total = white_list.count_users(self.prefix)
+        pages = max(1, -(-total // WHITELIST_PAGE_SIZE))
+        self.page = max(0, min(self.page, pages - 1))
+        usernames = white_list.page_usernames(
+            self.page * WHITELIST_PAGE_SIZE,
+            WHITELIST_PAGE_SIZE,
+            self.prefix,
+            self.by_sessions,
+        )
+        lines = []
+        for username in usernames:
+            user = white_list.get_user(username)
+            lines.append(
+                "{} ({}/{})".format(
+                    username, len(user.list_sessions()), user.get_session_limit()
+                )
+            )
+        embed = discord.Embed(
+            title=self.bot.wl_brand + " - Whitelist",
+            description="({}) Whitelisted: {}".format(total, "\n- ".join([""] + lines)),
+            color=0xFFFFFF,
+        )
+        embed.set_footer(text=f"Page {self.page + 1}/{pages}")
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= pages - 1
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.author.id
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        self.page -= 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
 
 class Administration(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    async def apply_edits(
+        self,
+        ctx: commands.Context,
+        edits: List[Tuple[int, str | None | object, Iterable[int], Iterable[int]]],
+        label: str,
+        priority: int = PRIORITY_BACKGROUND,
+    ) -> Tuple[discord.Message, Dict[str, int]]:
+        # Queues (member id, nick, add roles, remove roles) edits behind any
+        # action already queued for the member, reporting progress on a single
+        # reply that the caller finishes with its summary. Bulk edits yield to
+        # single logins and logouts by default.
+        progress = await ctx.reply(f"{label}...", ephemeral=True)
+        results = {"changed": 0, "skipped": 0, "failed": 0}
+        futures = []
+        for member_id, nick, add_roles, remove_roles in edits:
+            future = asyncio.get_running_loop().create_future()
+            self.bot.wl_actions.enqueue(
+                ctx.guild,
+                member_id,
+                nick=nick,
+                add_roles=add_roles,
+                remove_roles=remove_roles,
+                priority=priority,
+                done=future,
+            )
+            futures.append(future)
+        last_report = time.monotonic()
+        for done, future in enumerate(asyncio.as_completed(futures), 1):
+            changed = await future
+            if changed is None:
+                results["failed"] += 1
+            elif changed:
+                results["changed"] += 1
+            else:
+                results["skipped"] += 1
+            if time.monotonic() - last_report < MEMBER_EDIT_PROGRESS_INTERVAL:
+                continue
+            last_report = time.monotonic()
+            try:
+                await progress.edit(content=f"{label}... ({done}/{len(edits)})")
+            except discord.HTTPException:
+                pass
+        return progress, results
+
+    @staticmethod
+    async def finish_progress(
+        ctx: commands.Context, progress: discord.Message, summary: str
+    ):
+        try:
+            await progress.edit(content=summary)
+        except discord.HTTPException:
+            await ctx.reply(summary, ephemeral=True)
+
     @commands.hybrid_command(
         name="ping", usage=".ping", description="Sends pong or your specified message"
     )
@@ -17,7 +250,7 @@ class Administration(commands.Cog):
 
     @commands.hybrid_group(
         name="whitelist",
-        usage="whitelist ( list | ( add | remove  [session_id] [max_sessions] ) <name> )",
+        usage="whitelist ( list [prefix] [sort] [page] | import <file> [dry_run] [replace] | export [format] | ttl <name> [seconds] | ( add | remove  [session_id] [max_sessions] ) <name> )",
         description="Adds a new user to the whitelist",
     )
     @commands.guild_only()
@@ -26,7 +259,7 @@ class Administration(commands.Cog):
     async def whitelist(self, ctx: commands.Context):
         if ctx.invoked_subcommand is None:
             await ctx.reply(
-                "Please provide a valid sub command: `add`, `remove`, `list`",
+                "Please provide a valid sub command: `add`, `remove`, `list`, `import`, `export`, `ttl`",
                 ephemeral=True,
             )
             return
@@ -35,17 +268,23 @@ class Administration(commands.Cog):
     @commands.guild_only()
     @commands.has_permissions(manage_roles=True)
     @commands.cooldown(1, 2, commands.BucketType.member)
-    async def whitelist_list(self, ctx: commands.Context):
+    async def whitelist_list(
+        self,
+        ctx: commands.Context,
+        prefix: str = "",
+        sort: Literal["name", "sessions"] = "name",
+        page: int = 1,
+    ):
         await ctx.defer(ephemeral=True)
-        whitelisted = list(self.bot.wl_store.get_whitelist().list_users().keys())
-        embed = discord.Embed(
-            title=self.bot.wl_brand + " - Whitelist",
-            description="({}) Whitelisted: {}".format(
-                len(whitelisted), "\n- ".join([""] + whitelisted)
-            ),
-            color=0xFFFFFF,
+        view = WhitelistPages(
+            self.bot,
+            await self.bot.wl_stores.get(ctx.guild.id),
+            ctx.author,
+            normalize_username(prefix),
+            sort == "sessions",
+            page - 1,
         )
-        await ctx.reply(embed=embed, ephemeral=True)
+        await ctx.reply(embed=view.render(), view=view, ephemeral=True)
 
     @whitelist.command("add")
     @commands.guild_only()
@@ -61,8 +300,8 @@ class Administration(commands.Cog):
     ):
         await ctx.defer(ephemeral=True)
         pretty = pretty if pretty else username
-        username = username.lower().replace(" ", "")
-        white_list = self.bot.wl_store.get_whitelist()
+        username = normalize_username(username)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         default_session = [session_id.id] if session_id else []
         default_session_is_taken = bool(
             False
@@ -87,6 +326,15 @@ class Administration(commands.Cog):
             return
         white_list.add_user(username, pretty, max_sessions, default_session)
         user = white_list.get_user(username)
+        self.bot.wl_audit.record(
+            ctx.guild.id,
+            ctx.author.id,
+            "whitelist_add",
+            username,
+            session_id.id if session_id else None,
+            pretty=pretty,
+            session_limit=max_sessions,
+        )
         embed = discord.Embed(
             title=self.bot.wl_brand + " - Whitelist Add",
             description="Added {} to the whitelist!".format(username),
@@ -112,20 +360,23 @@ class Administration(commands.Cog):
         username: str,
     ):
         await ctx.defer(ephemeral=True)
-        username = username.lower().replace(" ", "")
-        white_list = self.bot.wl_store.get_whitelist()
+        username = normalize_username(username)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         username_is_taken = white_list.get_user(username)
         if not username_is_taken:
             embed = discord.Embed(
                 title=self.bot.wl_brand + " - Whitelist Remove",
-                description="Could not remove {} from the whtielist!\n```diff\n- There is no such whitelisted username -\n```".format(
-                    username
+                description="Could not remove {} from the whtielist!\n```diff\n- There is no such whitelisted username -\n```\n{}".format(
+                    username, await username_not_found(white_list, username)
                 ),
                 color=0xFFFFFF,
             )
             await ctx.reply(embed=embed, ephemeral=True)
             return
         white_list.remove_user(username)
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "whitelist_remove", username
+        )
         embed = discord.Embed(
             title=self.bot.wl_brand + " - Whitelist Remove",
             description="Removed {} from the whitelist!".format(username),
@@ -133,6 +384,127 @@ class Administration(commands.Cog):
         )
         await ctx.reply(embed=embed, ephemeral=True)
 
+    @whitelist.command("ttl")
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def whitelist_ttl(
+        self,
+        ctx: commands.Context,
+        username: str,
+        seconds: int = None,
+    ):
+        await ctx.defer(ephemeral=True)
+        username = normalize_username(username)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        user = white_list.get_user(username)
+        if user is None:
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
+            return
+        if seconds is not None and seconds < 0:
+            await ctx.reply("The session TTL cannot be negative", ephemeral=True)
+            return
+        user.session_ttl = seconds
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "ttl", username, ttl=seconds
+        )
+        if seconds is None:
+            ttl = f"the global TTL ({self.bot.wl_expiry.default_ttl or 'never'})"
+        elif seconds == 0:
+            ttl = "never"
+        else:
+            ttl = f"{seconds} seconds"
+        await ctx.reply(
+            f"Idle sessions of {username} now expire after: {ttl}", ephemeral=True
+        )
+
+    @whitelist.command("import")
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def whitelist_import(
+        self,
+        ctx: commands.Context,
+        file: discord.Attachment,
+        dry_run: bool = False,
+        replace: bool = False,
+    ):
+        await ctx.defer(ephemeral=True)
+        file_format = detect_format(file.filename)
+        if file_format is None:
+            await ctx.reply(
+                "Unsupported file type, please attach a `.csv`, `.jsonl` or `.json` file",
+                ephemeral=True,
+            )
+            return
+        data = await file.read()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        lines = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+        try:
+            rows, errors = parse_rows(lines, file_format, white_list, replace)
+        except UnicodeDecodeError:
+            errors = ["The file is not valid UTF-8"]
+        if errors:
+            shown = errors[:IMPORT_ERRORS_SHOWN]
+            if len(errors) > len(shown):
+                shown.append(f"... and {len(errors) - len(shown)} more")
+            embed = discord.Embed(
+                title=self.bot.wl_brand + " - Whitelist Import",
+                description="Could not import {}, nothing was changed!\n```diff\n{}\n```".format(
+                    file.filename, "\n".join(f"- {error}" for error in shown)
+                ),
+                color=0xFFFFFF,
+            )
+            await ctx.reply(embed=embed, ephemeral=True)
+            return
+        if dry_run:
+            description = "Dry run: {} would import {} users, nothing was changed.".format(
+                file.filename, len(rows)
+            )
+        else:
+            white_list.import_users(rows)
+            # One event per username, so .audit finds imports too
+            for row in rows:
+                self.bot.wl_audit.record(
+                    ctx.guild.id,
+                    ctx.author.id,
+                    "import",
+                    row["username"],
+                    file=file.filename,
+                    replace=replace,
+                )
+            description = "Imported {} users from {}!".format(len(rows), file.filename)
+        embed = discord.Embed(
+            title=self.bot.wl_brand + " - Whitelist Import",
+            description=description,
+            color=0xFFFFFF,
+        )
+        await ctx.reply(embed=embed, ephemeral=True)
+
+    @whitelist.command("export")
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def whitelist_export(
+        self, ctx: commands.Context, file_format: Literal["csv", "jsonl"] = "csv"
+    ):
+        await ctx.defer(ephemeral=True)
+        store = await self.bot.wl_stores.get(ctx.guild.id)
+        with store.snapshot() as snapshot:
+            content, count = await asyncio.to_thread(
+                export_rows, snapshot, file_format
+            )
+        await ctx.reply(
+            f"Exported {count} users!",
+            file=discord.File(
+                io.BytesIO(content.encode("utf-8")),
+                filename=f"whitelist.{file_format}",
+            ),
+            ephemeral=True,
+        )
+
     @commands.hybrid_command(
         name="evict", usage=".evict", description="Clears someone elses session"
     )
@@ -140,7 +512,7 @@ class Administration(commands.Cog):
     @commands.has_permissions(moderate_members=True)
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def session_term(self, ctx: commands.Context, target: discord.Member):
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         session = white_list.get_session(target.id)
         if session is None:
             await ctx.reply(
@@ -149,24 +521,20 @@ class Administration(commands.Cog):
             return
         user = white_list.get_user(session)
         user.drop_session(target.id)
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "evict", user.username, target.id
+        )
         await ctx.reply(f"Sessions cleared for {target.mention}", ephemeral=True)
-        try:
-            await target.edit(nick=None)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not change {target.mention}'s displayname!",
-                ephemeral=True,
-                delete_after=5.0,
-            )
-        try:
-            roles = [ctx.guild.get_role(roleid) for roleid in user.roles]
-            await target.remove_roles(*roles)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not derank {target.mention}!",
+        self.bot.wl_actions.logout(
+            ctx.guild,
+            target.id,
+            user,
+            on_failure=lambda: ctx.reply(
+                f"I could not change {target.mention}'s displayname or derank them!",
                 ephemeral=True,
                 delete_after=5.0,
-            )
+            ),
+        )
 
     @commands.hybrid_group(
         name="roles",
@@ -196,12 +564,23 @@ class Administration(commands.Cog):
         self, ctx: commands.Context, username: str, role: discord.Role
     ):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        username = normalize_username(username)
         user = white_list.get_user(username)
         if user is None:
-            await ctx.reply("Username does not exist", ephemeral=True)
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
             return
-        user.roles.append(role.id)
+        if not user.link_role(role.id):
+            await ctx.reply(
+                f"Failed: {role.mention} is already linked to {user.username}!",
+                ephemeral=True,
+            )
+            return
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "link", user.username, role=role.id
+        )
         await ctx.reply(
             f"Successfully linked {role.mention} to {user.username}!", ephemeral=True
         )
@@ -218,13 +597,18 @@ class Administration(commands.Cog):
         self, ctx: commands.Context, username: str, role: discord.Role
     ):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        username = normalize_username(username)
         user = white_list.get_user(username)
         if user is None:
-            await ctx.reply("Username does not exist", ephemeral=True)
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
             return
-        if role.id in user.roles:
-            user.roles.remove(role.id)
+        if user.unlink_role(role.id):
+            self.bot.wl_audit.record(
+                ctx.guild.id, ctx.author.id, "unlink", user.username, role=role.id
+            )
             await ctx.reply(
                 f"Successfully unlinked {role.mention} from {user.username}!",
                 ephemeral=True,
@@ -244,34 +628,219 @@ class Administration(commands.Cog):
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def roles_sync(self, ctx: commands.Context, username: str = None):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         if username:
+            username = normalize_username(username)
             user = white_list.get_user(username)
             if user is None:
-                await ctx.reply("Username does not exist", ephemeral=True)
+                await ctx.reply(
+                    await username_not_found(white_list, username), ephemeral=True
+                )
                 return
             users = [user]
         else:
             users = white_list.get_users().values()
-        for user in users:
-            roles = [ctx.guild.get_role(roleid) for roleid in user.roles]
-            for member_id in user.list_sessions():
-                member = await ctx.guild.fetch_member(member_id)
-                await member.add_roles(*roles)
-        if username:
+        sessions = [
+            (member_id, UNCHANGED, list(user.roles), ())
+            for user in users
+            if user.roles
+            for member_id in user.list_sessions()
+        ]
+        scope = user.username if username else "all whitelisted usernames"
+        progress, results = await self.apply_edits(
+            ctx, sessions, f"Syncing {len(sessions)} sessions of {scope}"
+        )
+        summary = "Synced all sessions of {}!\nChanged: {changed} | Skipped: {skipped} | Failed: {failed}".format(
+            scope, **results
+        )
+        await self.finish_progress(ctx, progress, summary)
+
+    @commands.hybrid_group(
+        name="batch",
+        usage=".batch ( evict <targets> | loginctl <username> <members> | ( link | unlink ) <role> <targets> )",
+        description="Runs moderation commands on many members or usernames at once",
+    )
+    @commands.guild_only()
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def batch(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
             await ctx.reply(
-                f"Synced all sessions of {user.username}!",
+                "Please provide a valid sub command: `evict`, `loginctl`, `link`, `unlink`",
                 ephemeral=True,
             )
-        else:
+            return
+
+    @batch.command(
+        name="evict",
+        usage=".batch evict <targets>",
+        description="Clears the sessions of members, usernames or everyone holding a role",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(moderate_members=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def batch_evict(self, ctx: commands.Context, *, targets: str):
+        await ctx.defer(ephemeral=True)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        member_ids, usernames, unknown = parse_targets(ctx.guild, white_list, targets)
+        for username in usernames:
+            member_ids.update(white_list.get_user(username).list_sessions())
+        edits = []
+        without_session = 0
+        for member_id in sorted(member_ids):
+            username = white_list.get_session(member_id)
+            if username is None:
+                without_session += 1
+                continue
+            user = white_list.get_user(username)
+            user.drop_session(member_id)
+            self.bot.wl_audit.record(
+                ctx.guild.id, ctx.author.id, "evict", username, member_id
+            )
+            edits.append((member_id, None, (), user.roles))
+        progress, results = await self.apply_edits(
+            ctx, edits, f"Evicting {len(edits)} sessions"
+        )
+        summary = format_batch_summary(
+            f"Evicted {len(edits)} sessions!",
+            results,
+            [
+                f"Without a session: {without_session}" if without_session else "",
+                format_unknown(unknown),
+            ],
+        )
+        await self.finish_progress(ctx, progress, summary)
+
+    @batch.command(
+        name="loginctl",
+        usage=".batch loginctl <username> <members>",
+        description="Adds all specified members to the session of the specified username",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def batch_loginctl(
+        self, ctx: commands.Context, username: str, *, members: str
+    ):
+        await ctx.defer(ephemeral=True)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        user = white_list.get_user(normalize_username(username))
+        if user is None:
             await ctx.reply(
-                f"Synced all sessions of all whitelisted usernames!",
-                ephemeral=True,
+                await username_not_found(white_list, username), ephemeral=True
             )
+            return
+        member_ids, usernames, unknown = parse_targets(ctx.guild, white_list, members)
+        # Only members can be logged in
+        unknown.extend(sorted(usernames))
+        edits = []
+        with_session = over_limit = 0
+        for member_id in sorted(member_ids):
+            if white_list.get_session(member_id) is not None:
+                with_session += 1
+                continue
+            try:
+                user.create_session(member_id)
+            except Exception:
+                over_limit += 1
+                continue
+            self.bot.wl_audit.record(
+                ctx.guild.id, ctx.author.id, "loginctl", user.username, member_id
+            )
+            edits.append((member_id, user.pretty, user.roles, ()))
+        progress, results = await self.apply_edits(
+            ctx, edits, f"Logging {len(edits)} members in as {user.pretty}"
+        )
+        summary = format_batch_summary(
+            f"Logged {len(edits)} members in as {user.pretty}!",
+            results,
+            [
+                f"Already had a session: {with_session}" if with_session else "",
+                f"Over the session limit: {over_limit}" if over_limit else "",
+                format_unknown(unknown),
+            ],
+        )
+        await self.finish_progress(ctx, progress, summary)
+
+    @batch.command(
+        name="link",
+        usage=".batch link <role> <targets>",
+        description="Links a role to many accounts and gives it to their sessions",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def batch_link(
+        self, ctx: commands.Context, role: discord.Role, *, targets: str
+    ):
+        await self.batch_roles(ctx, role, targets, True)
+
+    @batch.command(
+        name="unlink",
+        usage=".batch unlink <role> <targets>",
+        description="Unlinks a role from many accounts and takes it from their sessions",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(manage_roles=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def batch_unlink(
+        self, ctx: commands.Context, role: discord.Role, *, targets: str
+    ):
+        await self.batch_roles(ctx, role, targets, False)
+
+    async def batch_roles(
+        self, ctx: commands.Context, role: discord.Role, targets: str, link: bool
+    ):
+        await ctx.defer(ephemeral=True)
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        member_ids, usernames, unknown = parse_targets(ctx.guild, white_list, targets)
+        # Members stand for the username they are logged in as
+        without_session = 0
+        for member_id in member_ids:
+            username = white_list.get_session(member_id)
+            if username is None:
+                without_session += 1
+            else:
+                usernames.add(username)
+        changed = []
+        for username in sorted(usernames):
+            user = white_list.get_user(username)
+            if user.link_role(role.id) if link else user.unlink_role(role.id):
+                changed.append(user)
+                self.bot.wl_audit.record(
+                    ctx.guild.id,
+                    ctx.author.id,
+                    "link" if link else "unlink",
+                    username,
+                    role=role.id,
+                )
+        add_roles, remove_roles = ((role.id,), ()) if link else ((), (role.id,))
+        edits = [
+            (member_id, UNCHANGED, add_roles, remove_roles)
+            for user in changed
+            for member_id in user.list_sessions()
+        ]
+        verb = "Linked" if link else "Unlinked"
+        progress, results = await self.apply_edits(
+            ctx, edits, f"Updating {len(edits)} sessions of {len(changed)} usernames"
+        )
+        summary = format_batch_summary(
+            f"{verb} {role.mention} {'to' if link else 'from'} {len(changed)} usernames!",
+            results,
+            [
+                f"Unchanged usernames: {len(usernames) - len(changed)}"
+                if len(usernames) > len(changed)
+                else "",
+                f"Members without a session: {without_session}"
+                if without_session
+                else "",
+                format_unknown(unknown),
+            ],
+        )
+        await self.finish_progress(ctx, progress, summary)
 
     @commands.hybrid_group(
         name="data",
-        usage=".data ( save | age | reload )",
+        usage=".data ( save | age | reload | stats )",
         description="Allows managing the data store",
     )
     @commands.guild_only()
@@ -280,7 +849,7 @@ class Administration(commands.Cog):
     async def data_store(self, ctx: commands.Context):
         if ctx.invoked_subcommand is None:
             await ctx.reply(
-                "Please provide a valid sub command: `age`, `save`, `reload`",
+                "Please provide a valid sub command: `age`, `save`, `reload`, `stats`",
                 ephemeral=True,
             )
             return
@@ -294,8 +863,9 @@ class Administration(commands.Cog):
     @commands.has_permissions(manage_guild=True)
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def data_store_age(self, ctx: commands.Context):
-        tms = round(self.bot.wl_store.last_save.timestamp())
-        tml = round(self.bot.wl_store.last_update.timestamp())
+        store = await self.bot.wl_stores.get(ctx.guild.id)
+        tms = round(store.last_save.timestamp())
+        tml = round(store.last_update.timestamp())
         await ctx.reply(
             f"Last data store save was <t:{tms}:R>\nLast data store update (read) was <t:{tml}:R>",
             ephemeral=True,
@@ -311,7 +881,8 @@ class Administration(commands.Cog):
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def data_store_save(self, ctx: commands.Context):
         try:
-            self.bot.wl_store.save()
+            store = await self.bot.wl_stores.get(ctx.guild.id)
+            await store.save_async()
             await ctx.reply(f"Data store saved!", ephemeral=True)
         except:
             await ctx.reply(
@@ -328,13 +899,81 @@ class Administration(commands.Cog):
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def data_store_reload(self, ctx: commands.Context):
         try:
-            self.bot.wl_store.reload()
+            store = await self.bot.wl_stores.get(ctx.guild.id)
+            await store.reload_async()
             await ctx.reply(f"Data store reloaded!", ephemeral=True)
         except:
             await ctx.reply(
                 f"**ERROR:** Data store could not be reloaded!", ephemeral=True
             )
 
+    @data_store.command(
+        name="stats",
+        usage=".data stats",
+        description="Shows command, Discord API and data store statistics",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def data_store_stats(self, ctx: commands.Context):
+        store = await self.bot.wl_stores.get(ctx.guild.id)
+        with store.snapshot() as snapshot:
+            users, sessions = await asyncio.to_thread(snapshot.count)
+        requests = format_counters("whistle_discord_requests_total", "route")
+        limited = format_counters("whistle_discord_rate_limited_total", "route")
+        routes = sorted(requests.items(), key=lambda item: -item[1])
+        api = [
+            f"Requests: {sum(requests.values()):.0f} | 429s: {sum(limited.values()):.0f}"
+        ] + [
+            f"`{route}` {count:.0f}x, {limited.get(route, 0):.0f} 429s"
+            for route, count in routes[:STATS_ROWS_SHOWN]
+        ]
+        autosave = "No data yet"
+        if AUTOSAVE_SECONDS.count:
+            autosave = "{}x, mean {:.1f}ms, max {:.1f}ms | mean size {:.1f} KiB, max {:.1f} KiB".format(
+                AUTOSAVE_SECONDS.count,
+                AUTOSAVE_SECONDS.mean() * 1e3,
+                AUTOSAVE_SECONDS.max * 1e3,
+                AUTOSAVE_BYTES.mean() / 1024,
+                AUTOSAVE_BYTES.max / 1024,
+            )
+        embed = discord.Embed(
+            title=self.bot.wl_brand + " - Data Store Stats",
+            description="Collected since the bot started",
+            color=0xFFFFFF,
+        )
+        embed.add_field(
+            name="Whitelist",
+            value=f"Users: {users} | Sessions: {sessions} | Revision: {snapshot.revision}",
+            inline=False,
+        )
+        embed.add_field(
+            name="Commands",
+            value=format_histograms("whistle_command_seconds", "command", 1e3, "ms"),
+            inline=False,
+        )
+        embed.add_field(name="Discord API", value="\n".join(api), inline=False)
+        embed.add_field(
+            name="Store Loads",
+            value=format_histograms("whistle_store_load_seconds", "backend", 1e3, "ms"),
+            inline=True,
+        )
+        embed.add_field(
+            name="Store Saves",
+            value=format_histograms("whistle_store_save_seconds", "backend", 1e3, "ms"),
+            inline=True,
+        )
+        lookups = format_counters("whistle_store_lookups_total", "op")
+        timed = format_histograms("whistle_store_lookup_seconds", "op", 1e6, "µs")
+        if lookups:
+            counts = " | ".join(
+                f"`{op}` {count:.0f}x" for op, count in sorted(lookups.items())
+            )
+            timed = f"{counts}\n{timed}"
+        embed.add_field(name="Lookups", value=timed, inline=False)
+        embed.add_field(name="Autosaves", value=autosave, inline=False)
+        await ctx.reply(embed=embed, ephemeral=True)
+
     @commands.hybrid_command(
         name="loginctl",
         usage=".loginctl <member> <username>",
@@ -347,15 +986,17 @@ class Administration(commands.Cog):
         self, ctx: commands.Context, member: discord.Member, username: str
     ):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         session = white_list.get_session(member.id)
         if session is not None:
             await ctx.reply(f"{member.mention} already has a session!", ephemeral=True)
             return
-        username = username.lower().replace(" ", "")
+        username = normalize_username(username)
         user = white_list.get_user(username)
         if user is None:
-            await ctx.reply("Username does not exist", ephemeral=True)
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
             return
         try:
             user.create_session(member.id)
@@ -364,24 +1005,62 @@ class Administration(commands.Cog):
                 "This username cannot have any more sessions!", ephemeral=True
             )
             return
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "loginctl", user.username, member.id
+        )
         await ctx.reply(f"Logged {member.mention} in as {user.pretty}", ephemeral=True)
-        try:
-            await member.edit(nick=user.pretty)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not change {member.mention}'s displayname!",
+        self.bot.wl_actions.login(
+            ctx.guild,
+            member.id,
+            user,
+            on_failure=lambda: ctx.reply(
+                f"I could not change {member.mention}'s displayname or rank them!",
                 ephemeral=True,
                 delete_after=5.0,
+            ),
+        )
+
+    @commands.hybrid_command(
+        name="audit",
+        usage=".audit <username|member>",
+        description="Shows who recently changed the sessions or whitelisting of a username or member.",
+    )
+    @commands.guild_only()
+    @commands.has_permissions(moderate_members=True)
+    @commands.cooldown(1, 2, commands.BucketType.member)
+    async def audit(self, ctx: commands.Context, target: str):
+        await ctx.defer(ephemeral=True)
+        match = re.fullmatch(r"<@!?(\d+)>|(\d+)", target)
+        if match is not None:
+            member_id = int(match.group(1) or match.group(2))
+            subject = f"<@{member_id}>"
+            events = await self.bot.wl_audit.query(
+                ctx.guild.id, member_id=member_id, limit=AUDIT_EVENTS_SHOWN
             )
-        try:
-            roles = [ctx.guild.get_role(roleid) for roleid in user.roles]
-            await member.add_roles(*roles)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not rank {member.mention}!",
-                ephemeral=True,
-                delete_after=5.0,
+        else:
+            subject = normalize_username(target)
+            events = await self.bot.wl_audit.query(
+                ctx.guild.id, username=subject, limit=AUDIT_EVENTS_SHOWN
             )
+        embed = discord.Embed(
+            title=self.bot.wl_brand + " - Audit Log",
+            description="Newest changes involving {}{}".format(
+                subject,
+                "\n- ".join([""] + [format_audit_event(event) for event in events])
+                if events
+                else "\nNothing was recorded",
+            ),
+            color=0xFFFFFF,
+        )
+        await ctx.reply(embed=embed, ephemeral=True)
+
+    whitelist_remove.autocomplete("username")(username_autocomplete)
+    roles_link.autocomplete("username")(username_autocomplete)
+    roles_unlink.autocomplete("username")(username_autocomplete)
+    roles_sync.autocomplete("username")(username_autocomplete)
+    session_force_set.autocomplete("username")(username_autocomplete)
+    batch_loginctl.autocomplete("username")(username_autocomplete)
+    whitelist_ttl.autocomplete("username")(username_autocomplete)
 
 
 async def setup(bot: commands.Bot):
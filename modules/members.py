@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+
+import discord
+from discord.ext import commands
+
+from whistle_actions import PRIORITY_BACKGROUND, member_in_sync
+from whistle_store import User, wlStore
+
+log = logging.getLogger(__name__)
+
+# The sweep walks the sessions of loaded stores in small chunks, pausing in
+# between so command handlers and gateway events keep flowing.
+SESSION_SWEEP_INTERVAL = 3600
+SESSION_SWEEP_CHUNK = 250
+SESSION_SWEEP_PAUSE = 0.5
+# Activity in guilds whose store is not loaded is kept until it loads, for at
+# most this many members per guild
+ACTIVITY_BUFFER_SIZE = 10000
+
+
+class Members(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.__sweeper = None
+        self.__activity: Dict[int, Dict[int, int]] = {}
+
+    async def cog_load(self):
+        self.bot.wl_stores.on_load.append(self.apply_activity)
+        self.__sweeper = asyncio.get_running_loop().create_task(
+            self.sweeper(), name="Session Sweeper"
+        )
+
+    async def cog_unload(self):
+        self.bot.wl_stores.on_load.remove(self.apply_activity)
+        if self.__sweeper is not None:
+            self.__sweeper.cancel()
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild is not None:
+            self.touch(message.guild, message.author.id)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction: discord.Interaction):
+        if interaction.guild is not None:
+            self.touch(interaction.guild, interaction.user.id)
+
+    def touch(self, guild: discord.Guild, member_id: int):
+        # Loading a store per message would be far too expensive, activity in
+        # guilds whose store is not loaded is applied once it loads.
+        store = self.bot.wl_stores.peek(guild.id)
+        if store is None:
+            self.remember(guild.id, member_id)
+            return
+        white_list = store.get_whitelist()
+        username = white_list.get_session(member_id)
+        if username is not None:
+            user = white_list.get_user(username)
+            user.touch_session(
+                member_id, resolution=self.bot.wl_expiry.touch_resolution(user)
+            )
+            # Active sessions keep the store loaded
+            self.bot.wl_stores.mark_used(guild.id)
+
+    def remember(self, guild_id: int, member_id: int):
+        if not self.bot.wl_stores.exists(guild_id):
+            return
+        activity = self.__activity.setdefault(guild_id, {})
+        # Most recently active last, the longest idle member is dropped first
+        activity.pop(member_id, None)
+        activity[member_id] = int(time.time())
+        if len(activity) > ACTIVITY_BUFFER_SIZE:
+            del activity[next(iter(activity))]
+
+    def apply_activity(self, guild_id: int, store: wlStore):
+        # Registered as a wlStores on_load callback
+        activity = self.__activity.pop(guild_id, None)
+        if not activity:
+            return
+        white_list = store.get_whitelist()
+        for member_id, at in activity.items():
+            username = white_list.get_session(member_id)
+            if username is not None:
+                user = white_list.get_user(username)
+                user.touch_session(
+                    member_id, at, self.bot.wl_expiry.touch_resolution(user)
+                )
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        if not self.bot.wl_stores.exists(member.guild.id):
+            return
+        white_list = await self.bot.wl_stores.get_whitelist(member.guild.id)
+        username = white_list.get_session(member.id)
+        if username is None:
+            return
+        white_list.get_user(username).drop_session(member.id)
+        log.info(f"Dropped the {username} session of {member.id}, who left the guild")
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.nick == after.nick and before.roles == after.roles:
+            return
+        if not self.bot.wl_stores.exists(after.guild.id):
+            return
+        white_list = await self.bot.wl_stores.get_whitelist(after.guild.id)
+        username = white_list.get_session(after.id)
+        if username is None:
+            return
+        self.resync(after, white_list.get_user(username))
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        if not self.bot.wl_stores.exists(role.guild.id):
+            return
+        white_list = await self.bot.wl_stores.get_whitelist(role.guild.id)
+        usernames = white_list.users_with_role(role.id)
+        for username in usernames:
+            white_list.get_user(username).unlink_role(role.id)
+        if usernames:
+            log.info(f"Unlinked deleted role {role.id} from {len(usernames)} users")
+
+    def resync(self, member: discord.Member, user: User) -> bool:
+        if member_in_sync(member, user.pretty, user.roles):
+            return False
+        self.bot.wl_actions.login(
+            member.guild, member.id, user, priority=PRIORITY_BACKGROUND
+        )
+        return True
+
+    async def sweep(self, guild: discord.Guild, store: wlStore):
+        # Only a fully chunked member cache tells a departed member apart from
+        # one we have not seen yet.
+        if not guild.chunked:
+            return
+        white_list = store.get_whitelist()
+        session_ids = white_list.list_session_ids()
+        dropped = resynced = 0
+        for start in range(0, len(session_ids), SESSION_SWEEP_CHUNK):
+            if self.bot.wl_stores.peek(guild.id) is not store:
+                # Unloaded (and closed) while the sweep paused
+                return
+            for member_id in session_ids[start : start + SESSION_SWEEP_CHUNK]:
+                # Sessions can change while the sweep pauses
+                username = white_list.get_session(member_id)
+                if username is None:
+                    continue
+                user = white_list.get_user(username)
+                member = guild.get_member(member_id)
+                if member is None:
+                    user.drop_session(member_id)
+                    dropped += 1
+                elif self.resync(member, user):
+                    resynced += 1
+            await asyncio.sleep(SESSION_SWEEP_PAUSE)
+        if dropped or resynced:
+            log.info(
+                f"Session sweep of {guild.id}: dropped {dropped}, resynced {resynced}"
+            )
+
+    async def sweeper(self, interval: float = SESSION_SWEEP_INTERVAL):
+        while 1:
+            await asyncio.sleep(interval)
+            # Stores that are not loaded get checked again once they are, the
+            # sweep does not count as a use that keeps them loaded.
+            for guild_id, store in self.bot.wl_stores.loaded().items():
+                guild = self.bot.get_guild(guild_id)
+                if guild is None:
+                    continue
+                try:
+                    await self.sweep(guild, store)
+                except Exception as e:
+                    log.error(f"Session sweep of {guild_id} failed: {e}")
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Members(bot))
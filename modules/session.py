@@ -1,6 +1,9 @@
 import discord
 from discord.ext import commands
 
+from whistle_autocomplete import username_autocomplete, username_not_found
+from whistle_store import normalize_username
+
 
 class User(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -16,15 +19,17 @@ class User(commands.Cog):
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def session_set(self, ctx: commands.Context, username: str):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         session = white_list.get_session(ctx.author.id)
         if session is not None:
             await ctx.reply("You already have a session!", ephemeral=True)
             return
-        username = username.lower().replace(" ", "")
+        username = normalize_username(username)
         user = white_list.get_user(username)
         if user is None:
-            await ctx.reply("Username does not exist", ephemeral=True)
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
             return
         try:
             user.create_session(ctx.author.id)
@@ -33,24 +38,20 @@ class User(commands.Cog):
                 "This username cannot have any more sessions!", ephemeral=True
             )
             return
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "login", user.username, ctx.author.id
+        )
         await ctx.reply(f"Logged in as {user.pretty}", ephemeral=True)
-        try:
-            await ctx.author.edit(nick=user.pretty)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not change your displayname!",
+        self.bot.wl_actions.login(
+            ctx.guild,
+            ctx.author.id,
+            user,
+            on_failure=lambda: ctx.reply(
+                f"I could not change your displayname or rank you!",
                 ephemeral=True,
                 delete_after=5.0,
-            )
-        try:
-            roles = [ctx.guild.get_role(roleid) for roleid in user.roles]
-            await ctx.author.add_roles(*roles)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not rank you!",
-                ephemeral=True,
-                delete_after=5.0,
-            )
+            ),
+        )
 
     @commands.hybrid_command(
         name="logout", usage=".logout", description="Clears your sessions"
@@ -59,31 +60,27 @@ class User(commands.Cog):
     @commands.has_permissions()
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def session_clear(self, ctx: commands.Context):
-        white_list = self.bot.wl_store.get_whitelist()
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
         session = white_list.get_session(ctx.author.id)
         if session is None:
             await ctx.reply("You do not have any sessions!", ephemeral=True)
             return
         user = white_list.get_user(session)
         user.drop_session(ctx.author.id)
+        self.bot.wl_audit.record(
+            ctx.guild.id, ctx.author.id, "logout", user.username, ctx.author.id
+        )
         await ctx.reply("Sessions cleared", ephemeral=True)
-        try:
-            await ctx.author.edit(nick=None)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not change your displayname!",
+        self.bot.wl_actions.logout(
+            ctx.guild,
+            ctx.author.id,
+            user,
+            on_failure=lambda: ctx.reply(
+                f"I could not change your displayname or derank you!",
                 ephemeral=True,
                 delete_after=5.0,
-            )
-        try:
-            roles = [ctx.guild.get_role(roleid) for roleid in user.roles]
-            await ctx.author.remove_roles(*roles)
-        except Exception as e:
-            await ctx.reply(
-                f"I could not derank you!",
-                ephemeral=True,
-                delete_after=5.0,
-            )
+            ),
+        )
 
     @commands.hybrid_command(
         name="whois",
@@ -95,11 +92,13 @@ class User(commands.Cog):
     @commands.cooldown(1, 2, commands.BucketType.member)
     async def session_whois(self, ctx: commands.Context, username: str):
         await ctx.defer(ephemeral=True)
-        white_list = self.bot.wl_store.get_whitelist()
-        username = username.lower().replace(" ", "")
+        white_list = await self.bot.wl_stores.get_whitelist(ctx.guild.id)
+        username = normalize_username(username)
         user = white_list.get_user(username)
         if user is None:
-            await ctx.reply("Username does not exist", ephemeral=True)
+            await ctx.reply(
+                await username_not_found(white_list, username), ephemeral=True
+            )
             return
         embed = discord.Embed(
             title=self.bot.wl_brand + " - Whitelist WhoIS",
@@ -111,7 +110,25 @@ class User(commands.Cog):
         )
         embed.add_field(
             name="Sessions",
-            value="\n- ".join([""] + [f"<@{id}>" for id in user.list_sessions()]),
+            value="\n- ".join(
+                [""]
+                + [
+                    "<@{}> since <t:{}:R>, active <t:{}:R>".format(
+                        id, *user.get_session_times(id)
+                    )
+                    for id in user.list_sessions()
+                ]
+            ),
+            inline=True,
+        )
+        ttl = (
+            user.session_ttl
+            if user.session_ttl is not None
+            else self.bot.wl_expiry.default_ttl
+        )
+        embed.add_field(
+            name="Session TTL",
+            value=f"{ttl} seconds idle" if ttl else "Never expires",
             inline=True,
         )
         embed.add_field(
@@ -126,6 +143,9 @@ class User(commands.Cog):
         )
         await ctx.reply(embed=embed, ephemeral=True)
 
+    session_set.autocomplete("username")(username_autocomplete)
+    session_whois.autocomplete("username")(username_autocomplete)
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(User(bot))
@@ -0,0 +1,143 @@
+import asyncio
+
+import discord
+
+from benchmarks.fakes import FakeGuild
+from whistle_actions import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_COMMAND,
+    UNCHANGED,
+    wlActionQueue,
+    wlMemberAction,
+)
+
+
+class FakeClient:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+
+    def get_guild(self, guild_id: int) -> FakeGuild | None:
+        return self.guild if guild_id == self.guild.id else None
+
+
+def record_edits(guild: FakeGuild, member_id: int, edits: list, fail=None):
+    # Every edit of the member is recorded, fail can raise before it applies
+    member = guild.get_member(member_id)
+    edit = member.edit
+
+    async def recorded(**changes):
+        edits.append((member_id, changes))
+        if fail is not None:
+            fail()
+        await edit(**changes)
+
+    member.edit = recorded
+    return member
+
+
+def role_ids(changes: dict) -> set:
+    return {role.id for role in changes["roles"]}
+
+
+def test_merge_keeps_the_end_state():
+    action = wlMemberAction(1, PRIORITY_COMMAND, 0)
+    action.merge("Alice", [5, 6], [], None)
+    action.merge(None, [], [5], None)
+    action.merge(UNCHANGED, [7], [], None)
+    assert action.nick is None
+    assert action.add_roles == {6, 7}
+    assert action.remove_roles == {5}
+
+
+def test_pending_actions_coalesce():
+    guild = FakeGuild(1)
+    edits = []
+    member = record_edits(guild, 101, edits)
+
+    async def run():
+        queue = wlActionQueue(guild.id, FakeClient(guild))
+        loop = asyncio.get_running_loop()
+        done = [loop.create_future() for _ in range(3)]
+        queue.enqueue(101, nick="Alice", add_roles=[5], done=done[0])
+        queue.enqueue(101, nick=None, remove_roles=[5], done=done[1])
+        queue.enqueue(101, add_roles=[6], done=done[2])
+        return await asyncio.gather(*done)
+
+    assert asyncio.run(run()) == [True, True, True]
+    assert len(edits) == 1
+    assert member.nick is None
+    assert {role.id for role in member.roles} == {6}
+
+
+def test_priority_bump_jumps_the_queue():
+    guild = FakeGuild(1)
+    edits = []
+    for member_id in (101, 102, 103):
+        record_edits(guild, member_id, edits)
+
+    async def run():
+        queue = wlActionQueue(guild.id, FakeClient(guild), concurrency=1)
+        done = asyncio.get_running_loop().create_future()
+        for member_id in (101, 102, 103):
+            queue.enqueue(member_id, add_roles=[5], priority=PRIORITY_BACKGROUND)
+        queue.enqueue(102, add_roles=[6], priority=PRIORITY_COMMAND)
+        queue.enqueue(103, add_roles=[6], priority=PRIORITY_BACKGROUND, done=done)
+        await done
+
+    asyncio.run(run())
+    assert [member_id for member_id, _ in edits] == [102, 101, 103]
+    assert role_ids(edits[0][1]) == {5, 6}
+
+
+def test_rate_limited_action_merges_newer_ones():
+    guild = FakeGuild(1)
+    edits = []
+    queued = []
+    queue = None
+
+    def rate_limit():
+        if len(edits) == 1:
+            # Queued while the first edit is in flight
+            queued.append(asyncio.get_running_loop().create_future())
+            queue.enqueue(101, add_roles=[6], done=queued[-1])
+            raise discord.RateLimited(0.01)
+
+    member = record_edits(guild, 101, edits, rate_limit)
+
+    async def run():
+        nonlocal queue
+        queue = wlActionQueue(guild.id, FakeClient(guild))
+        done = asyncio.get_running_loop().create_future()
+        queue.enqueue(101, nick="Alice", add_roles=[5], done=done)
+        return await done, await queued[0]
+
+    assert asyncio.run(run()) == (True, True)
+    assert len(edits) == 2
+    assert edits[1][1]["nick"] == "Alice"
+    assert role_ids(edits[1][1]) == {5, 6}
+    assert {role.id for role in member.roles} == {5, 6}
+
+
+def test_failed_action_runs_its_failure_callbacks():
+    guild = FakeGuild(1)
+    edits = []
+    failures = []
+
+    def forbidden():
+        raise Exception("Missing permissions")
+
+    record_edits(guild, 101, edits, forbidden)
+
+    async def on_failure():
+        failures.append(101)
+
+    async def run():
+        queue = wlActionQueue(guild.id, FakeClient(guild))
+        done = asyncio.get_running_loop().create_future()
+        queue.enqueue(101, add_roles=[5], on_failure=on_failure)
+        queue.enqueue(101, add_roles=[6], on_failure=on_failure, done=done)
+        return await done
+
+    assert asyncio.run(run()) is None
+    assert len(edits) == 1
+    assert failures == [101, 101]
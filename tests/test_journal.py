@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from whistle_journal import wlJournal
+from whistle_store import wlStore
+
+
+def mutate(store: wlStore):
+    white_list = store.get_whitelist()
+    white_list.add_user("alice", "Alice", 2, [], [5])
+    white_list.add_user("bob", "Bob", 1)
+    alice = white_list.get_user("alice")
+    alice.create_session(101, 1000)
+    alice.link_role(6)
+    alice.unlink_role(5)
+    alice.session_ttl = 60
+    white_list.get_user("bob").create_session(102, 1000)
+    white_list.remove_user("bob")
+    white_list.import_users([{"username": "carol", "sessions": [103]}])
+
+
+@pytest.mark.parametrize("backend", ["json", "msgpack", "sqlite"])
+def test_replay_round_trip(tmp_path, backend):
+    path = str(tmp_path / f"store.{backend}")
+
+    async def run():
+        store = wlStore(path, backend)
+        mutate(store)
+        # Committed but never saved as a snapshot
+        await store.commit()
+        return store.jsonify()
+
+    expected = asyncio.run(run())
+    assert wlStore(path, backend).jsonify() == expected
+
+
+def test_truncated_journal_tail(tmp_path):
+    path = str(tmp_path / "store.json")
+
+    async def run():
+        store = wlStore(path, "json")
+        mutate(store)
+        await store.commit()
+        return store.revision
+
+    revision = asyncio.run(run())
+    with open(path + ".journal", "ab") as file:
+        file.write(b'{"rev":%d,"op":"add","user":"torn"' % (revision + 1))
+    store = wlStore(path, "json")
+    assert store.revision == revision
+    assert store.get_whitelist().get_user("torn") is None
+
+    # The torn line is cut off, so records appended after it replay
+    async def append():
+        journal = wlJournal(path + ".journal")
+        journal.append({"rev": revision + 1, "op": "add", "user": "dave", "data": {}})
+        await journal.flush()
+
+    asyncio.run(append())
+    revisions = [record["rev"] for record in wlJournal.read(path + ".journal")]
+    assert revisions[-1] == revision + 1
+    assert wlStore(path, "json").get_whitelist().get_user("dave") is not None
+
+
+def test_compaction_keeps_newer_records(tmp_path):
+    path = str(tmp_path / "store.journal")
+
+    async def run():
+        journal = wlJournal(path)
+        for revision in range(1, 6):
+            journal.append({"rev": revision, "op": "remove", "user": "x"})
+        await journal.flush()
+        # Still buffered when the snapshot at revision 3 is folded in
+        journal.append({"rev": 6, "op": "remove", "user": "x"})
+        await journal.truncate(3)
+        return journal.size
+
+    size = asyncio.run(run())
+    assert [record["rev"] for record in wlJournal.read(path)] == [4, 5, 6]
+    assert size == os.path.getsize(path)
+
+
+def test_save_compacts_the_journal(tmp_path):
+    path = str(tmp_path / "store.json")
+
+    async def run():
+        store = wlStore(path, "json")
+        mutate(store)
+        await store.save_async()
+        store.get_whitelist().add_user("erin")
+        await store.commit()
+        return store.revision, store.jsonify()
+
+    revision, expected = asyncio.run(run())
+    with open(path, "rb") as file:
+        snapshot_revision = json.load(file)["revision"]
+    records = list(wlJournal.read(path + ".journal"))
+    assert [record["rev"] for record in records] == [revision]
+    assert snapshot_revision == revision - 1
+    assert wlStore(path, "json").jsonify() == expected
+
+
+
+def test_reload_keeps_changes_made_meanwhile(tmp_path, monkeypatch):
+    path = str(tmp_path / "store.json")
+    truncate = wlJournal._wlJournal__truncate
+
+    def slow_truncate(self, lines, revision):
+        # Lets a change in while the journal is compacted
+        time.sleep(0.1)
+        truncate(self, lines, revision)
+
+    monkeypatch.setattr(wlJournal, "_wlJournal__truncate", slow_truncate)
+
+    async def run():
+        store = wlStore(path, "json")
+        white_list = store.get_whitelist()
+        white_list.add_user("alice")
+        reload = asyncio.create_task(store.reload_async())
+        await asyncio.sleep(0.05)
+        white_list.add_user("bob")
+        await reload
+        store.get_whitelist().add_user("carol")
+        await store.commit()
+        return store.jsonify()
+
+    expected = asyncio.run(run())
+    assert {"alice", "bob", "carol"} <= set(expected["whitelist"])
+    revisions = [record["rev"] for record in wlJournal.read(path + ".journal")]
+    assert len(revisions) == len(set(revisions))
+    assert wlStore(path, "json").jsonify() == expected
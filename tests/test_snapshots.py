@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from whistle_backend import wlSnapshotBackend
+from whistle_store import Whitelist, wlStore
+from tests.test_journal import mutate
+
+
+def change(white_list: Whitelist):
+    # Touches every kind of user change a snapshot has to hold back
+    alice = white_list.get_user("alice")
+    alice.create_session(104, 2000)
+    alice.link_role(7)
+    alice.pretty = "Alice Renamed"
+    white_list.remove_user("carol")
+    white_list.add_user("dave", "Dave", 1)
+
+
+def test_snapshot_keeps_the_state_it_was_taken_at(tmp_path):
+    store = wlStore(str(tmp_path / "store.json"), "json")
+    mutate(store)
+    expected = store.jsonify()
+    white_list = store.get_whitelist()
+    with store.snapshot() as snapshot:
+        change(white_list)
+        assert snapshot.jsonify() == expected
+        assert snapshot.get("dave") is None
+        assert snapshot.get("carol") is not None
+    assert store.jsonify() != expected
+
+
+@pytest.mark.parametrize("snapshot_format", ["json", "msgpack"])
+def test_cached_fragments_keep_the_snapshot_state(tmp_path, snapshot_format):
+    path = str(tmp_path / f"store.{snapshot_format}")
+
+    backend = wlSnapshotBackend(path, snapshot_format)
+
+    async def save(white_list: Whitelist):
+        with white_list.snapshot() as snapshot:
+            await backend.save(snapshot, snapshot.revision)
+
+    async def run():
+        store = wlStore(path, snapshot_format)
+        mutate(store)
+        await store.close()
+        json_data, _ = backend.load()
+        white_list = wlStore.from_json(json_data)["whitelist"]
+        white_list.listener = backend.record
+        # The first save encodes every user and caches the fragments
+        await save(white_list)
+        before = {"revision": white_list.revision, "whitelist": white_list.jsonify()}
+        with white_list.snapshot() as snapshot:
+            change(white_list)
+            await backend.save(snapshot, snapshot.revision)
+        saved = wlSnapshotBackend.load_store(path, snapshot_format)
+        # Users that changed after the snapshot are encoded by the next save
+        await save(white_list)
+        after = {"revision": white_list.revision, "whitelist": white_list.jsonify()}
+        return before, saved, after
+
+    before, saved, after = asyncio.run(run())
+    assert saved == before
+    assert wlSnapshotBackend.load_store(path, snapshot_format) == after
@@ -0,0 +1,26 @@
+import asyncio
+import os
+
+from whistle_store import wlStore, wlStores
+from tests.test_journal import mutate
+
+
+def test_legacy_json_store_migrates_into_sqlite(tmp_path):
+    legacy = str(tmp_path / "store.json")
+
+    async def run():
+        store = wlStore(legacy, "json")
+        mutate(store)
+        # Part of the legacy data only exists in its journal
+        await store.commit()
+        expected = store.jsonify()
+        stores = wlStores(str(tmp_path / "stores"), "sqlite", legacy, 1)
+        migrated = (await stores.get(1)).jsonify()
+        await stores.unload_all()
+        return expected, migrated, stores.path(1)
+
+    expected, migrated, path = asyncio.run(run())
+    assert migrated == expected
+    assert wlStore(path, "sqlite").jsonify() == expected
+    assert not os.path.exists(legacy)
+    assert os.path.exists(legacy + ".migrated")
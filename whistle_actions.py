@@ -0,0 +1,303 @@
+import asyncio
+import heapq
+import itertools
+from typing import Awaitable, Callable, Dict, Iterable, List, Set
+
+import discord
+
+from whistle_store import User
+
+# Lower values drain first
+PRIORITY_COMMAND = 0
+PRIORITY_BACKGROUND = 10
+
+# Seconds to hold a guild's queue after Discord answered with a 429
+RATE_LIMIT_BACKOFF = 5.0
+# Members of one guild edited at the same time
+ACTION_CONCURRENCY = 4
+
+# Marks a queued action that leaves the member's nick alone
+UNCHANGED = object()
+
+
+class wlMemberAction:
+    member_id: int
+    priority: int
+    sequence: int
+    nick: str | None | object
+    add_roles: Set[int]
+    remove_roles: Set[int]
+    on_failure: List[Callable[[], Awaitable]]
+    # Resolved with True once applied, False if nothing needed to change and
+    # None if it failed
+    done: List[asyncio.Future]
+
+    def __init__(self, member_id: int, priority: int, sequence: int):
+        self.member_id = member_id
+        self.priority = priority
+        self.sequence = sequence
+        self.nick = UNCHANGED
+        self.add_roles = set()
+        self.remove_roles = set()
+        self.on_failure = []
+        self.done = []
+
+    def merge(
+        self,
+        nick: str | None | object,
+        add_roles: Iterable[int],
+        remove_roles: Iterable[int],
+        on_failure: Callable[[], Awaitable] | None,
+        done: asyncio.Future | None = None,
+    ):
+        # Folding actions in order leaves only their combined end state, so a
+        # queued login followed by a logout cancels out.
+        add_roles = set(add_roles)
+        remove_roles = set(remove_roles)
+        if nick is not UNCHANGED:
+            self.nick = nick
+        self.add_roles = (self.add_roles - remove_roles) | add_roles
+        self.remove_roles = (self.remove_roles - add_roles) | remove_roles
+        if on_failure is not None:
+            self.on_failure.append(on_failure)
+        if done is not None:
+            self.done.append(done)
+
+    def resolve(self, changed: bool | None):
+        for done in self.done:
+            if not done.done():
+                done.set_result(changed)
+
+
+class wlActionQueue:
+    # Only the guild id is kept, the Guild object (and its member cache) is
+    # replaced by discord.py after a reconnect that could not resume
+    guild_id: int
+    __client: discord.Client
+    __pending: Dict[int, wlMemberAction]
+    __heap: List[tuple]
+    __sequence: itertools.count
+    __wakeup: asyncio.Event
+    __worker: asyncio.Task | None
+    # Members with an edit in flight, their next action waits for it
+    __applying: Set[int]
+    __running: Set[asyncio.Task]
+    __slots: asyncio.Semaphore
+    __held_until: float
+
+    def __init__(
+        self,
+        guild_id: int,
+        client: discord.Client,
+        concurrency: int = ACTION_CONCURRENCY,
+    ):
+        self.guild_id = guild_id
+        self.__client = client
+        self.__pending = {}
+        self.__heap = []
+        self.__sequence = itertools.count()
+        self.__wakeup = asyncio.Event()
+        self.__worker = None
+        self.__applying = set()
+        self.__running = set()
+        self.__slots = asyncio.Semaphore(max(1, concurrency))
+        self.__held_until = 0.0
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def enqueue(
+        self,
+        member_id: int,
+        nick: str | None | object = UNCHANGED,
+        add_roles: Iterable[int] = (),
+        remove_roles: Iterable[int] = (),
+        priority: int = PRIORITY_COMMAND,
+        on_failure: Callable[[], Awaitable] | None = None,
+        done: asyncio.Future | None = None,
+    ):
+        action = self.__pending.get(member_id, None)
+        if action is None:
+            action = wlMemberAction(member_id, priority, next(self.__sequence))
+            self.__pending[member_id] = action
+            heapq.heappush(self.__heap, (priority, action.sequence, member_id))
+        elif priority < action.priority:
+            # The stale heap entry is skipped once the newer one is popped
+            action.priority = priority
+            action.sequence = next(self.__sequence)
+            heapq.heappush(self.__heap, (priority, action.sequence, member_id))
+        action.merge(nick, add_roles, remove_roles, on_failure, done)
+        self.__wakeup.set()
+        if self.__worker is None or self.__worker.done():
+            self.__worker = asyncio.get_running_loop().create_task(
+                self.__drain(), name=f"wlActionQueue {self.guild_id}"
+            )
+
+    def __pop(self) -> wlMemberAction | None:
+        waiting = []
+        try:
+            while self.__heap:
+                entry = heapq.heappop(self.__heap)
+                _, sequence, member_id = entry
+                action = self.__pending.get(member_id, None)
+                if action is None or action.sequence != sequence:
+                    continue
+                if member_id in self.__applying:
+                    waiting.append(entry)
+                    continue
+                del self.__pending[member_id]
+                return action
+            return None
+        finally:
+            for entry in waiting:
+                heapq.heappush(self.__heap, entry)
+
+    async def __drain(self):
+        loop = asyncio.get_running_loop()
+        while 1:
+            await self.__slots.acquire()
+            action = None
+            while action is None:
+                held = self.__held_until - loop.time()
+                if held > 0:
+                    await asyncio.sleep(held)
+                    continue
+                action = self.__pop()
+                if action is None:
+                    self.__wakeup.clear()
+                    await self.__wakeup.wait()
+            self.__applying.add(action.member_id)
+            task = loop.create_task(self.__run(action))
+            self.__running.add(task)
+            task.add_done_callback(self.__running.discard)
+
+    async def __run(self, action: wlMemberAction):
+        try:
+            action.resolve(await self.apply(action))
+        except discord.RateLimited as e:
+            self.__requeue(action)
+            self.__hold(e.retry_after)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self.__requeue(action)
+                self.__hold(RATE_LIMIT_BACKOFF)
+            else:
+                await self.__failed(action)
+        except Exception:
+            await self.__failed(action)
+        finally:
+            self.__applying.discard(action.member_id)
+            self.__slots.release()
+            self.__wakeup.set()
+
+    def __hold(self, delay: float):
+        # The whole guild waits, edits already in flight finish on their own
+        self.__held_until = max(
+            self.__held_until, asyncio.get_running_loop().time() + delay
+        )
+
+    def __requeue(self, action: wlMemberAction):
+        # Anything queued for the member meanwhile happened after this action
+        newer = self.__pending.pop(action.member_id, None)
+        action.sequence = next(self.__sequence)
+        if newer is not None:
+            action.priority = min(action.priority, newer.priority)
+            action.merge(newer.nick, newer.add_roles, newer.remove_roles, None)
+            action.on_failure.extend(newer.on_failure)
+            action.done.extend(newer.done)
+        self.__pending[action.member_id] = action
+        heapq.heappush(
+            self.__heap, (action.priority, action.sequence, action.member_id)
+        )
+
+    async def __failed(self, action: wlMemberAction):
+        action.resolve(None)
+        for on_failure in action.on_failure:
+            try:
+                await on_failure()
+            except discord.HTTPException:
+                pass
+
+    async def apply(self, action: wlMemberAction) -> bool:
+        guild = self.__client.get_guild(self.guild_id)
+        if guild is None:
+            raise Exception(f"Guild {self.guild_id} is not available")
+        member = guild.get_member(action.member_id)
+        if member is None:
+            member = await guild.fetch_member(action.member_id)
+        return await apply_member_state(
+            member, action.nick, action.add_roles, action.remove_roles
+        )
+
+
+async def apply_member_state(
+    member: discord.Member,
+    nick: str | None | object,
+    add_roles: Iterable[int],
+    remove_roles: Iterable[int],
+) -> bool:
+    # Sends the nick and the complete role list in a single edit, or nothing
+    # at all when the member already looks the way it should.
+    guild = member.guild
+    current = {role.id: role for role in member.roles if not role.is_default()}
+    target = dict(current)
+    for role_id in remove_roles:
+        target.pop(role_id, None)
+    for role_id in add_roles:
+        role = guild.get_role(role_id)
+        if role is not None and not role.is_default():
+            target[role_id] = role
+    changes = {}
+    if nick is not UNCHANGED and member.nick != nick:
+        changes["nick"] = nick
+    if target.keys() != current.keys():
+        changes["roles"] = list(target.values())
+    if not changes:
+        return False
+    await member.edit(**changes)
+    return True
+
+
+def member_in_sync(
+    member: discord.Member, nick: str | None, role_ids: Iterable[int]
+) -> bool:
+    # Roles the guild no longer has are left to the role delete listener
+    if member.nick != nick:
+        return False
+    current = {role.id for role in member.roles}
+    return all(
+        role_id in current or member.guild.get_role(role_id) is None
+        for role_id in role_ids
+    )
+
+
+class wlActionQueues:
+    __client: discord.Client
+    __concurrency: int
+    __queues: Dict[int, wlActionQueue]
+
+    def __init__(self, client: discord.Client, concurrency: int = ACTION_CONCURRENCY):
+        self.__client = client
+        self.__concurrency = concurrency
+        self.__queues = {}
+
+    def get(self, guild: discord.Guild) -> wlActionQueue:
+        queue = self.__queues.get(guild.id, None)
+        if queue is None:
+            queue = self.__queues[guild.id] = wlActionQueue(
+                guild.id, self.__client, self.__concurrency
+            )
+        return queue
+
+    def enqueue(self, guild: discord.Guild, member_id: int, **kwargs):
+        self.get(guild).enqueue(member_id, **kwargs)
+
+    def login(self, guild: discord.Guild, member_id: int, user: User, **kwargs):
+        self.enqueue(
+            guild, member_id, nick=user.pretty, add_roles=user.roles, **kwargs
+        )
+
+    def logout(self, guild: discord.Guild, member_id: int, user: User, **kwargs):
+        self.enqueue(
+            guild, member_id, nick=None, remove_roles=user.roles, **kwargs
+        )
@@ -0,0 +1,322 @@
+import gzip
+import json
+import logging
+import lzma
+import os
+import shutil
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Set
+
+from whistle_journal import repair_tail, wlGroupCommit
+
+log = logging.getLogger(__name__)
+
+# Events are written together shortly after they happen, off the event loop
+AUDIT_COMMIT_DELAY = 1.0
+# Segment size (bytes) that closes it, and the number of closed segments kept
+AUDIT_SEGMENT_SIZE = 4 * 1024 * 1024
+AUDIT_SEGMENTS_KEPT = 50
+# Newest events answered from memory
+AUDIT_RECENT_EVENTS = 1000
+AUDIT_QUERY_LIMIT = 50
+
+# Closed segments are compressed with one of these, by file extension
+AUDIT_COMPRESSIONS = {"gzip": ".gz", "lzma": ".xz"}
+SEGMENT_PREFIX = "audit-"
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx"
+
+
+def event_keys(event: Dict) -> Set[str]:
+    # What the segment index knows about an event, and what queries ask for
+    keys = set()
+    if event.get("user") is not None:
+        keys.add(user_key(event["guild"], event["user"]))
+    for member_id in (event.get("actor"), event.get("member")):
+        if member_id is not None:
+            keys.add(member_key(event["guild"], member_id))
+    return keys
+
+
+def user_key(guild_id: int, username: str) -> str:
+    return f"u{guild_id}:{username}"
+
+
+def member_key(guild_id: int, member_id: int) -> str:
+    return f"m{guild_id}:{member_id}"
+
+
+def open_segment(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def read_segment(path: str) -> Iterator[Dict]:
+    with open_segment(path) as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn tail of the active segment, nothing follows it
+                return
+
+
+class wlAuditSegment:
+    # The sparse index of a segment: its sequence range and every username
+    # and member it mentions. Queries only open segments that mention them.
+    path: str
+    first_seq: int
+    last_seq: int
+    keys: Set[str]
+
+    def __init__(self, path: str, first_seq: int, last_seq: int, keys: Set[str]):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        self.keys = keys
+
+    def add(self, event: Dict):
+        self.last_seq = event["seq"]
+        self.keys |= event_keys(event)
+
+    def jsonify(self) -> Dict:
+        return {
+            "first_seq": self.first_seq,
+            "last_seq": self.last_seq,
+            "keys": sorted(self.keys),
+        }
+
+    @staticmethod
+    def scan(path: str) -> "wlAuditSegment | None":
+        segment = None
+        for event in read_segment(path):
+            if segment is None:
+                segment = wlAuditSegment(path, event["seq"], event["seq"], set())
+            segment.add(event)
+        return segment
+
+
+class wlAuditLog:
+    # An append-only record of who changed sessions and the whitelist. The
+    # active segment is plain JSON lines; once it grows past segment_size it
+    # is compressed, gets its index written next to it, and the oldest
+    # segments beyond the retention cap are deleted.
+    __directory: str
+    __segment_size: int
+    __segments_kept: int
+    __compression: str
+    __seq: int
+    __recent: Deque[Dict]
+    __commit: wlGroupCommit
+    __segments: List[wlAuditSegment]
+    __active: wlAuditSegment | None
+    __active_size: int
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = AUDIT_SEGMENT_SIZE,
+        segments_kept: int = AUDIT_SEGMENTS_KEPT,
+        compression: str = "gzip",
+        commit_delay: float = AUDIT_COMMIT_DELAY,
+    ):
+        if compression not in AUDIT_COMPRESSIONS:
+            raise Exception(f"Unknown audit log compression {compression}")
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__segments_kept = segments_kept
+        self.__compression = compression
+        self.__recent = deque(maxlen=AUDIT_RECENT_EVENTS)
+        self.__commit = wlGroupCommit(self.__write, commit_delay)
+        self.__segments = []
+        self.__active = None
+        self.__active_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__load()
+
+    def __load(self):
+        names = sorted(os.listdir(self.__directory))
+        closed = {}
+        for name in names:
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(".tmp"):
+                # A compression cut short, the raw segment is still there
+                os.remove(os.path.join(self.__directory, name))
+                continue
+            stem, _, extension = name.partition(SEGMENT_SUFFIX)
+            if name.startswith(SEGMENT_PREFIX) and extension in (".gz", ".xz"):
+                closed[stem] = os.path.join(self.__directory, name)
+        for stem, path in closed.items():
+            segment = self.__load_index(stem, path)
+            if segment is not None:
+                self.__segments.append(segment)
+        raws = [
+            name
+            for name in names
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        ]
+        for name in raws:
+            path = os.path.join(self.__directory, name)
+            stem = name[: -len(SEGMENT_SUFFIX)]
+            if stem in closed:
+                # Compressed before a crash, but not removed yet
+                os.remove(path)
+                continue
+            repair_tail(path)
+            segment = wlAuditSegment.scan(path)
+            if segment is None:
+                os.remove(path)
+                continue
+            if self.__active is not None:
+                # Only the newest segment stays open
+                self.__close_active()
+            self.__active = segment
+            self.__active_size = os.path.getsize(path)
+        seqs = [segment.last_seq for segment in self.__segments]
+        if self.__active is not None:
+            seqs.append(self.__active.last_seq)
+        self.__seq = max(seqs) + 1 if seqs else 0
+
+    def __load_index(self, stem: str, path: str) -> wlAuditSegment | None:
+        index_path = os.path.join(self.__directory, stem + INDEX_SUFFIX)
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            return wlAuditSegment(
+                path, index["first_seq"], index["last_seq"], set(index["keys"])
+            )
+        except (OSError, ValueError, KeyError):
+            log.info(f"Rebuilding the audit index of {path}")
+            segment = wlAuditSegment.scan(path)
+            if segment is not None:
+                self.__write_index(segment, index_path)
+            return segment
+
+    def record(
+        self,
+        guild_id: int,
+        actor_id: int | None,
+        action: str,
+        username: str | None = None,
+        member_id: int | None = None,
+        **details,
+    ):
+        event = {
+            "seq": self.__seq,
+            "time": int(time.time()),
+            "guild": guild_id,
+            "actor": actor_id,
+            "action": action,
+            "user": username,
+            "member": member_id,
+            **details,
+        }
+        self.__seq += 1
+        self.__recent.append(event)
+        self.__commit.append(event)
+
+    async def flush(self):
+        await self.__commit.flush()
+
+    def __write(self, events: List[Dict]):
+        for event in events:
+            if self.__active is None:
+                path = os.path.join(
+                    self.__directory,
+                    f"{SEGMENT_PREFIX}{event['seq']:012d}{SEGMENT_SUFFIX}",
+                )
+                self.__active = wlAuditSegment(path, event["seq"], event["seq"], set())
+                self.__active_size = 0
+            line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+            with open(self.__active.path, "ab") as file:
+                file.write(line)
+            self.__active.add(event)
+            self.__active_size += len(line)
+            if self.__active_size >= self.__segment_size:
+                self.__close_active()
+        self.__expire()
+
+    def __close_active(self):
+        segment, self.__active = self.__active, None
+        raw_path = segment.path
+        stem = os.path.basename(raw_path)[: -len(SEGMENT_SUFFIX)]
+        segment.path = raw_path + AUDIT_COMPRESSIONS[self.__compression]
+        temp_path = segment.path + ".tmp"
+        with open(raw_path, "rb") as source:
+            if self.__compression == "lzma":
+                target = lzma.open(temp_path, "wb")
+            else:
+                target = gzip.open(temp_path, "wb")
+            with target:
+                shutil.copyfileobj(source, target)
+        self.__write_index(segment, os.path.join(self.__directory, stem + INDEX_SUFFIX))
+        os.replace(temp_path, segment.path)
+        os.remove(raw_path)
+        self.__segments.append(segment)
+
+    @staticmethod
+    def __write_index(segment: wlAuditSegment, index_path: str):
+        with open(index_path, "w", encoding="utf-8") as file:
+            json.dump(segment.jsonify(), file, separators=(",", ":"))
+
+    def __expire(self):
+        while len(self.__segments) > self.__segments_kept:
+            segment = self.__segments.pop(0)
+            stem = os.path.basename(segment.path).partition(SEGMENT_SUFFIX)[0]
+            for path in (
+                segment.path,
+                os.path.join(self.__directory, stem + INDEX_SUFFIX),
+            ):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def query(
+        self,
+        guild_id: int,
+        username: str | None = None,
+        member_id: int | None = None,
+        limit: int = AUDIT_QUERY_LIMIT,
+    ) -> List[Dict]:
+        # Newest first. The recent events are searched in memory, older ones
+        # only in the segments whose index mentions the username or member.
+        key = (
+            user_key(guild_id, username)
+            if username is not None
+            else member_key(guild_id, member_id)
+        )
+        found = []
+        for event in reversed(self.__recent):
+            if len(found) >= limit:
+                return found
+            if key in event_keys(event):
+                found.append(event)
+        before = self.__recent[0]["seq"] if self.__recent else self.__seq
+        await self.flush()
+        async with self.__commit.lock:
+            found.extend(
+                await self.__commit.run(self.__search, key, before, limit - len(found))
+            )
+        return found
+
+    def __search(self, key: str, before: int, limit: int) -> List[Dict]:
+        found = []
+        segments = list(self.__segments)
+        if self.__active is not None:
+            segments.append(self.__active)
+        for segment in reversed(segments):
+            if len(found) >= limit:
+                break
+            if segment.first_seq >= before or key not in segment.keys:
+                continue
+            matches = [
+                event
+                for event in read_segment(segment.path)
+                if event["seq"] < before and key in event_keys(event)
+            ]
+            found.extend(reversed(matches[-(limit - len(found)) :]))
+        return found
@@ -0,0 +1,33 @@
+from typing import List
+
+import discord
+from discord import app_commands
+
+from whistle_store import Whitelist, normalize_username
+
+# Discord shows at most 25 autocomplete choices
+AUTOCOMPLETE_LIMIT = 25
+# Closest usernames offered when a username does not exist
+SUGGESTIONS_SHOWN = 3
+
+
+async def username_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> List[app_commands.Choice[str]]:
+    if interaction.guild_id is None:
+        return []
+    white_list = await interaction.client.wl_stores.get_whitelist(interaction.guild_id)
+    prefix = normalize_username(current)
+    return [
+        app_commands.Choice(name=username, value=username)
+        for username in white_list.find_usernames(prefix, AUTOCOMPLETE_LIMIT)
+    ]
+
+
+async def username_not_found(white_list: Whitelist, username: str) -> str:
+    suggestions = await white_list.suggest_usernames(username, SUGGESTIONS_SHOWN)
+    if not suggestions:
+        return "Username does not exist"
+    return "Username does not exist, did you mean {}?".format(
+        ", ".join(f"`{suggestion}`" for suggestion in suggestions)
+    )
@@ -0,0 +1,525 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import msgpack
+
+from whistle_journal import (
+    JOURNAL_COMMIT_DELAY,
+    JOURNAL_COMPACT_SIZE,
+    wlGroupCommit,
+    wlJournal,
+)
+
+INITIAL_DATA = {
+    "whitelist": {
+        "example_user": {
+            "pretty": "Example User",
+            "session_limit": 0,
+            "sessions": [],
+            "roles": [],
+        }
+    }
+}
+
+
+class wlBackend:
+    # Incremental backends persist every change record on their own and do not
+    # need full snapshots written to stay durable.
+    incremental: bool = False
+
+    def load(self) -> Tuple[Dict, List[Dict]]:
+        raise NotImplementedError
+
+    def record(self, record: Dict):
+        raise NotImplementedError
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def save(self, snapshot, revision: int) -> int | None:
+        # Saves a wlSnapshot (None for incremental backends) and returns the
+        # size of the written snapshot, if the backend writes one
+        raise NotImplementedError
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+SNAPSHOT_FORMATS = ("json", "msgpack")
+
+
+class wlSnapshotBackend(wlBackend):
+    # Every user's encoded entry is cached between saves, a save only encodes
+    # the users that changed since the last one and joins the rest as is.
+    __file_path: str
+    __snapshot_format: str
+    __journal: wlJournal
+    __fragments: Dict[str, bytes] | None
+    # Username -> revision of its newest change since the last save
+    __stale: Dict[str, int]
+
+    def __init__(self, file_path: str, snapshot_format: str = "json"):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise Exception(f"Unknown snapshot format {snapshot_format}")
+        self.__file_path = file_path
+        self.__snapshot_format = snapshot_format
+        self.__journal = wlJournal(file_path + ".journal")
+        self.__fragments = None
+        self.__stale = {}
+
+    def load(self) -> Tuple[Dict, List[Dict]]:
+        json_data = self.load_store(self.__file_path, self.__snapshot_format)
+        revision = json_data.get("revision", 0)
+        records = [
+            record
+            for record in wlJournal.read(self.__file_path + ".journal")
+            if record["rev"] > revision
+        ]
+        # The first save after a load encodes every user
+        self.__fragments = None
+        self.__stale = {}
+        return json_data, records
+
+    def record(self, record: Dict):
+        self.__journal.append(record)
+        if record["op"] == "import":
+            for row in record["users"]:
+                self.__stale[row["username"]] = record["rev"]
+        elif record["user"] is not None:
+            self.__stale[record["user"]] = record["rev"]
+
+    async def flush(self):
+        await self.__journal.flush()
+
+    async def save(self, snapshot, revision: int) -> int:
+        # Users changed from here on are encoded by the next save
+        stale, self.__stale = self.__stale, {}
+        try:
+            size = await asyncio.to_thread(self.__save_snapshot, snapshot, stale)
+        except:
+            self.__restale(stale, -1)
+            raise
+        # Changed after the snapshot was taken, so encoded as they were before
+        self.__restale(stale, snapshot.revision)
+        await self.__journal.truncate(revision)
+        return size
+
+    def __restale(self, stale: Dict[str, int], revision: int):
+        for username, changed in stale.items():
+            if changed > revision:
+                self.__stale[username] = max(changed, self.__stale.get(username, 0))
+
+    def __save_snapshot(self, snapshot, stale: Dict[str, int]) -> int:
+        fragments = self.__fragments
+        if fragments is None:
+            fragments = {
+                username: self.encode_fragment(
+                    username, state.jsonify(), self.__snapshot_format
+                )
+                for username, state in snapshot.items()
+            }
+        else:
+            for username in stale:
+                state = snapshot.get(username)
+                if state is None:
+                    fragments.pop(username, None)
+                else:
+                    fragments[username] = self.encode_fragment(
+                        username, state.jsonify(), self.__snapshot_format
+                    )
+        self.__fragments = fragments
+        encoded = self.join_fragments(
+            snapshot.revision, fragments, self.__snapshot_format
+        )
+        return self.write_store(self.__file_path, encoded)
+
+    def needs_compaction(self) -> bool:
+        return self.__journal.size >= JOURNAL_COMPACT_SIZE
+
+    @staticmethod
+    def create_initial_store(file_path, snapshot_format: str = "json"):
+        wlSnapshotBackend.save_store(file_path, INITIAL_DATA, snapshot_format)
+
+    @staticmethod
+    def detect_format(data: bytes) -> str:
+        # A JSON store is always an object, a msgpack store always a map
+        # (0x80-0x8f, 0xde or 0xdf), so the first byte tells them apart.
+        stripped = data.lstrip()
+        if not stripped or stripped[:1] == b"{":
+            return "json"
+        return "msgpack"
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        if wlSnapshotBackend.detect_format(data) == "json":
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    @staticmethod
+    def encode(data: Dict, snapshot_format: str = "json") -> bytes:
+        if snapshot_format == "msgpack":
+            return msgpack.packb(data, use_bin_type=True)
+        return json.dumps(data).encode("utf-8")
+
+    @staticmethod
+    def encode_fragment(username: str, user_data: Dict, snapshot_format: str) -> bytes:
+        # One whitelist entry, as encode() would write it inside the whitelist
+        if snapshot_format == "msgpack":
+            return msgpack.packb(username) + msgpack.packb(user_data, use_bin_type=True)
+        return (json.dumps(username) + ": " + json.dumps(user_data)).encode("utf-8")
+
+    @staticmethod
+    def join_fragments(
+        revision: int, fragments: Dict[str, bytes], snapshot_format: str
+    ) -> bytes:
+        # The same bytes encode() produces for the whole store
+        if snapshot_format == "msgpack":
+            packer = msgpack.Packer(use_bin_type=True)
+            return (
+                packer.pack_map_header(2)
+                + packer.pack("revision")
+                + packer.pack(revision)
+                + packer.pack("whitelist")
+                + packer.pack_map_header(len(fragments))
+                + b"".join(fragments.values())
+            )
+        return (
+            b'{"revision": %d, "whitelist": {' % revision
+            + b", ".join(fragments.values())
+            + b"}}"
+        )
+
+    @staticmethod
+    def load_store(file_path, snapshot_format: str = "json"):
+        if not os.path.exists(file_path):
+            wlSnapshotBackend.create_initial_store(file_path, snapshot_format)
+        with open(file_path, "rb") as file:
+            data = file.read()
+        try:
+            return wlSnapshotBackend.decode(data)
+        except ValueError as e:
+            # Never replace a store we cannot read, it may still be recoverable
+            raise Exception(
+                f"Data store {file_path} is corrupt and was left untouched: {e}"
+            )
+
+    @staticmethod
+    def save_store(file_path, data, snapshot_format: str = "json") -> int:
+        return wlSnapshotBackend.write_store(
+            file_path, wlSnapshotBackend.encode(data, snapshot_format)
+        )
+
+    @staticmethod
+    def write_store(file_path, encoded: bytes) -> int:
+        # Write to a temporary file next to the store and atomically swap it
+        # in, so a crash mid-write leaves the previous store intact. Every
+        # write gets its own temporary file, a save that is still running
+        # never shares one with the next.
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(
+            prefix=os.path.basename(file_path) + ".", suffix=".tmp", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(encoded)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        wlSnapshotBackend.fsync_directory(directory)
+        return len(encoded)
+
+    @staticmethod
+    def fsync_directory(directory):
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class wlSqliteBackend(wlBackend):
+    incremental = True
+    __connection: sqlite3.Connection
+    __executor: ThreadPoolExecutor
+    __commit: wlGroupCommit
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            pretty TEXT NOT NULL,
+            session_limit INTEGER NOT NULL,
+            session_ttl INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            member_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username, position);
+        CREATE TABLE IF NOT EXISTS roles (
+            username TEXT NOT NULL,
+            role_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (username, role_id)
+        );
+        CREATE INDEX IF NOT EXISTS roles_role_id ON roles (role_id);
+    """
+
+    # Columns added after the first release, created on older databases.
+    # Sessions from before session times start their clock at the migration.
+    MIGRATIONS = (
+        ("users", "session_ttl", "INTEGER", False),
+        ("sessions", "created", "INTEGER NOT NULL DEFAULT 0", True),
+        ("sessions", "active", "INTEGER NOT NULL DEFAULT 0", True),
+    )
+
+    def __init__(self, file_path: str, commit_delay: float = JOURNAL_COMMIT_DELAY):
+        # All statements run on a single worker thread, one at a time
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix="wlSqlite")
+        self.__commit = wlGroupCommit(self.__write, commit_delay, self.__executor)
+        self.__connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript(self.SCHEMA)
+        self.__migrate()
+        if self.__get_revision() is None:
+            self.replace_all(INITIAL_DATA)
+
+    def __migrate(self):
+        db = self.__connection
+        now = int(time.time())
+        with db:
+            for table, column, definition, backfill in self.MIGRATIONS:
+                columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+                if column in columns:
+                    continue
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                if backfill:
+                    db.execute(f"UPDATE {table} SET {column} = ?", (now,))
+
+    def __get_revision(self) -> int | None:
+        row = self.__connection.execute(
+            "SELECT value FROM meta WHERE key = 'revision'"
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self) -> Tuple[Dict, List[Dict]]:
+        db = self.__connection
+        white_list = {
+            username: {
+                "pretty": pretty,
+                "session_limit": session_limit,
+                "session_ttl": session_ttl,
+                "sessions": [],
+                "session_times": [],
+                "roles": [],
+            }
+            for username, pretty, session_limit, session_ttl in db.execute(
+                "SELECT username, pretty, session_limit, session_ttl FROM users"
+            )
+        }
+        for username, member_id, created, active in db.execute(
+            "SELECT username, member_id, created, active FROM sessions ORDER BY position"
+        ):
+            white_list[username]["sessions"].append(member_id)
+            white_list[username]["session_times"].append((created, active))
+        for username, role_id in db.execute(
+            "SELECT username, role_id FROM roles ORDER BY position"
+        ):
+            white_list[username]["roles"].append(role_id)
+        return {"revision": self.__get_revision() or 0, "whitelist": white_list}, []
+
+    def replace_all(self, data: Dict):
+        db = self.__connection
+        revision = data.get("revision", 0)
+        with db:
+            db.execute("DELETE FROM users")
+            db.execute("DELETE FROM sessions")
+            db.execute("DELETE FROM roles")
+            for username, user_data in data.get("whitelist").items():
+                self.__insert_user(db, username, user_data, revision << 32)
+            self.__set_revision(db, revision)
+
+    def record(self, record: Dict):
+        self.__commit.append(record)
+
+    async def flush(self):
+        await self.__commit.flush()
+
+    async def save(self, snapshot, revision: int) -> None:
+        await self.flush()
+
+    def close(self):
+        self.__commit.flush_sync()
+        self.__executor.shutdown()
+        self.__connection.close()
+
+    def __write(self, records: List[Dict]):
+        # One transaction per batch of change records
+        db = self.__connection
+        with db:
+            for record in records:
+                self.__apply(db, record)
+            self.__set_revision(db, records[-1]["rev"])
+
+    @staticmethod
+    def __set_revision(db: sqlite3.Connection, revision: int):
+        db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('revision', ?)",
+            (revision,),
+        )
+
+    @staticmethod
+    def __insert_user(db: sqlite3.Connection, username: str, data: Dict, position: int):
+        db.execute(
+            "INSERT INTO users (username, pretty, session_limit, session_ttl) VALUES (?, ?, ?, ?)",
+            (
+                username,
+                data.get("pretty", username),
+                data.get("session_limit", 1),
+                data.get("session_ttl", None),
+            ),
+        )
+        sessions = data.get("sessions", [])
+        times = data.get("session_times", [])
+        if len(times) != len(sessions):
+            now = int(time.time())
+            times = [(now, now)] * len(sessions)
+        db.executemany(
+            "INSERT OR REPLACE INTO sessions (member_id, username, position, created, active) VALUES (?, ?, ?, ?, ?)",
+            [
+                (member_id, username, position + index, created, active)
+                for index, (member_id, (created, active)) in enumerate(
+                    zip(sessions, times)
+                )
+            ],
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO roles (username, role_id, position) VALUES (?, ?, ?)",
+            [
+                (username, role_id, position + index)
+                for index, role_id in enumerate(data.get("roles", []))
+            ],
+        )
+
+    @staticmethod
+    def __delete_user(db: sqlite3.Connection, username: str):
+        db.execute("DELETE FROM users WHERE username = ?", (username,))
+        db.execute("DELETE FROM sessions WHERE username = ?", (username,))
+        db.execute("DELETE FROM roles WHERE username = ?", (username,))
+
+    def __apply(self, db: sqlite3.Connection, record: Dict):
+        op = record["op"]
+        username = record["user"]
+        # Row positions are derived from the record revision, which keeps
+        # sessions and roles in the order they were added.
+        position = record["rev"] << 32
+        if op == "add":
+            self.__delete_user(db, username)
+            self.__insert_user(db, username, record["data"], position)
+        elif op == "remove":
+            self.__delete_user(db, username)
+        elif op == "import":
+            for row in record["users"]:
+                self.__delete_user(db, row["username"])
+                self.__insert_user(db, row["username"], row, position)
+        elif op == "login":
+            at = record.get("at", None) or int(time.time())
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (member_id, username, position, created, active) VALUES (?, ?, ?, ?, ?)",
+                (record["session"], username, position, at, at),
+            )
+        elif op == "touch":
+            db.execute(
+                "UPDATE sessions SET active = ? WHERE member_id = ? AND username = ?",
+                (record["at"], record["session"], username),
+            )
+        elif op == "ttl":
+            db.execute(
+                "UPDATE users SET session_ttl = ? WHERE username = ?",
+                (record["ttl"], username),
+            )
+        elif op == "logout":
+            db.execute(
+                "DELETE FROM sessions WHERE member_id = ? AND username = ?",
+                (record["session"], username),
+            )
+        elif op == "logout_all":
+            db.execute("DELETE FROM sessions WHERE username = ?", (username,))
+        elif op == "limit":
+            db.execute(
+                "UPDATE users SET session_limit = ? WHERE username = ?",
+                (record["limit"], username),
+            )
+            db.execute(
+                """DELETE FROM sessions WHERE username = ? AND member_id NOT IN (
+                    SELECT member_id FROM sessions WHERE username = ?
+                    ORDER BY position LIMIT ?
+                )""",
+                (username, username, max(record["limit"], 0)),
+            )
+        elif op == "pretty":
+            db.execute(
+                "UPDATE users SET pretty = ? WHERE username = ?",
+                (record["pretty"], username),
+            )
+        elif op == "link":
+            db.execute(
+                "INSERT OR IGNORE INTO roles (username, role_id, position) VALUES (?, ?, ?)",
+                (username, record["role"], position),
+            )
+        elif op == "unlink":
+            db.execute(
+                "DELETE FROM roles WHERE username = ? AND role_id = ?",
+                (username, record["role"]),
+            )
+        else:
+            raise Exception(f"Unknown change record operation {op}")
+
+
+BACKEND_EXTENSIONS = {
+    "json": ".json",
+    "msgpack": ".msgpack",
+    "sqlite": ".db",
+}
+
+BACKENDS = {
+    "json": lambda file_path: wlSnapshotBackend(file_path, "json"),
+    "msgpack": lambda file_path: wlSnapshotBackend(file_path, "msgpack"),
+    "sqlite": wlSqliteBackend,
+}
+
+
+def create_backend(name: str, file_path: str) -> wlBackend:
+    backend = BACKENDS.get(name, None)
+    if backend is None:
+        raise Exception(
+            f"Unknown data store backend {name} - Expected one of: {', '.join(BACKENDS)}"
+        )
+    return backend(file_path)
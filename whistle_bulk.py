@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from whistle_store import Whitelist, normalize_username, wlSnapshot
+
+BULK_FIELDS = ("username", "pretty", "session_limit", "sessions", "roles")
+BULK_FORMATS = ("csv", "jsonl", "json")
+
+
+def detect_format(filename: str) -> str | None:
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension in BULK_FORMATS:
+        return extension
+    return None
+
+
+def read_records(
+    lines: Iterable[str], file_format: str
+) -> Iterator[Tuple[str, Dict | Exception]]:
+    # Yields (where, raw record) one row at a time, e.g. ("Line 3", {...})
+    if file_format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield f"Line {reader.line_num}", record
+        return
+    if file_format == "json":
+        # A single array of row objects
+        try:
+            records = json.loads("".join(lines))
+        except json.JSONDecodeError as e:
+            yield "File", e
+            return
+        if not isinstance(records, list):
+            yield "File", ValueError("expected an array of objects")
+            return
+        for item_number, record in enumerate(records, 1):
+            yield f"Item {item_number}", record
+        return
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield f"Line {line_number}", e
+            continue
+        yield f"Line {line_number}", record
+
+
+def parse_limit(value) -> int:
+    if value is None or value == "":
+        return 1
+    return int(value)
+
+
+def parse_ids(value) -> List[int]:
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        value = value.replace(",", " ").split()
+    if isinstance(value, int) or not isinstance(value, (list, tuple)):
+        raise ValueError(f"expected a list of ids, got {value!r}")
+    return [int(item) for item in value]
+
+
+def parse_rows(
+    lines: Iterable[str],
+    file_format: str,
+    white_list: Whitelist,
+    replace: bool = False,
+) -> Tuple[List[Dict], List[str]]:
+    # Parses and validates every row in a single pass, collecting all errors
+    rows = []
+    errors = []
+    usernames = {}
+    sessions = {}
+    for where, record in read_records(lines, file_format):
+        if isinstance(record, Exception):
+            errors.append(f"{where}: {record}")
+            continue
+        if not isinstance(record, dict):
+            errors.append(f"{where}: expected an object")
+            continue
+        username = normalize_username(str(record.get("username") or ""))
+        if not username:
+            errors.append(f"{where}: missing username")
+            continue
+        try:
+            row = {
+                "username": username,
+                "pretty": str(record.get("pretty") or username),
+                "session_limit": parse_limit(record.get("session_limit")),
+                "sessions": parse_ids(record.get("sessions")),
+                "roles": parse_ids(record.get("roles")),
+            }
+        except (TypeError, ValueError) as e:
+            errors.append(f"{where}: {e}")
+            continue
+        if username in usernames:
+            errors.append(
+                f"{where}: {username} is already on {usernames[username].lower()}"
+            )
+            continue
+        usernames[username] = where
+        if not replace and white_list.get_user(username) is not None:
+            errors.append(f"{where}: {username} is already whitelisted")
+        if row["session_limit"] < 0:
+            errors.append(f"{where}: session_limit cannot be negative")
+        if len(row["sessions"]) > row["session_limit"]:
+            errors.append(
+                f"{where}: {len(row['sessions'])} sessions exceed the limit of {row['session_limit']}"
+            )
+        for session_id in row["sessions"]:
+            if session_id in sessions:
+                errors.append(
+                    f"{where}: session {session_id} is already on {sessions[session_id][1].lower()}"
+                )
+                continue
+            sessions[session_id] = (username, where)
+        rows.append(row)
+    # Sessions held in the store only free up when the import replaces their
+    # holder, which a row further down may do.
+    for session_id, (username, where) in sessions.items():
+        holder = white_list.get_session(session_id)
+        if holder is not None and holder not in usernames:
+            errors.append(
+                f"{where}: session {session_id} is already held by {holder}"
+            )
+    return rows, errors
+
+
+def export_rows(snapshot: wlSnapshot, file_format: str) -> Tuple[str, int]:
+    # Returns the exported text and the number of users in it. Only reads the
+    # snapshot, so it can run in a worker thread.
+    output = io.StringIO()
+    if file_format == "csv":
+        writer = csv.DictWriter(output, BULK_FIELDS)
+        writer.writeheader()
+    count = 0
+    for username, state in snapshot.items():
+        count += 1
+        row = {
+            "username": username,
+            "pretty": state.pretty,
+            "session_limit": state.session_limit,
+            "sessions": list(state.sessions),
+            "roles": list(state.roles),
+        }
+        if file_format == "csv":
+            row["sessions"] = " ".join(map(str, row["sessions"]))
+            row["roles"] = " ".join(map(str, row["roles"]))
+            writer.writerow(row)
+        else:
+            output.write(json.dumps(row) + "\n")
+    return output.getvalue(), count
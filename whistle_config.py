@@ -2,3 +2,21 @@ from decouple import config
 
 wl_token = config("wl_token")
 wl_brand = config("wl_brand", "Whistle")
+wl_store_backend = config("wl_store_backend", "json")
+wl_store_file = config("wl_store_file", "store.json")
+wl_store_directory = config("wl_store_directory", "stores")
+wl_store_legacy_guild = config("wl_store_legacy_guild", 0, cast=int)
+wl_store_idle_timeout = config("wl_store_idle_timeout", 1800, cast=int)
+wl_log_level = config("wl_log_level", "INFO")
+wl_metrics_host = config("wl_metrics_host", "127.0.0.1")
+wl_metrics_port = config("wl_metrics_port", 0, cast=int)
+wl_command_hash_file = config("wl_command_hash_file", "commands.hash")
+wl_session_ttl = config("wl_session_ttl", 0, cast=int)
+wl_lookup_host = config("wl_lookup_host", "127.0.0.1")
+wl_lookup_port = config("wl_lookup_port", 0, cast=int)
+wl_lookup_socket = config("wl_lookup_socket", "")
+wl_audit_directory = config("wl_audit_directory", "audit")
+wl_audit_segment_size = config("wl_audit_segment_size", 4194304, cast=int)
+wl_audit_segments_kept = config("wl_audit_segments_kept", 50, cast=int)
+wl_audit_compression = config("wl_audit_compression", "gzip")
+wl_action_concurrency = config("wl_action_concurrency", 4, cast=int)
@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Callable, Dict, List, Tuple
+
+from whistle_store import (
+    SESSION_TOUCH_RESOLUTION,
+    User,
+    Whitelist,
+    wlStore,
+    wlStores,
+)
+
+log = logging.getLogger(__name__)
+
+# Sessions expired before the scheduler yields to the event loop
+EXPIRY_BATCH = 500
+
+
+class wlSessionExpiry:
+    # A single task sleeps until the earliest deadline on a heap. Entries are
+    # not updated when a session sees activity or goes away; the deadline is
+    # recomputed from the store when the entry comes up, and pushed back if
+    # it moved later.
+    default_ttl: int
+    __stores: wlStores
+    __on_expired: Callable[[int, int, User], None]
+    __heap: List[Tuple[float, int, int]]
+    __deadlines: Dict[Tuple[int, int], float]
+    __wakeup: asyncio.Event
+
+    def __init__(
+        self,
+        stores: wlStores,
+        default_ttl: int,
+        on_expired: Callable[[int, int, User], None],
+    ):
+        self.default_ttl = default_ttl
+        self.__stores = stores
+        self.__on_expired = on_expired
+        self.__heap = []
+        self.__deadlines = {}
+        self.__wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.__deadlines)
+
+    def attach(self, guild_id: int, store: wlStore):
+        # Registered as a wlStores on_load callback
+        store.observers.append(
+            lambda record: self.__changed(guild_id, store.get_whitelist(), record)
+        )
+        self.schedule_all(guild_id, store.get_whitelist())
+
+    def schedule_all(self, guild_id: int, white_list: Whitelist):
+        for session_id in white_list.list_session_ids():
+            self.schedule(guild_id, white_list, session_id)
+
+    def __changed(self, guild_id: int, white_list: Whitelist, record: Dict):
+        op = record["op"]
+        if op == "login":
+            self.schedule(guild_id, white_list, record["session"])
+        elif op in ("add", "ttl"):
+            user = white_list.get_user(record["user"])
+            for session_id in user.list_sessions() if user is not None else ():
+                self.schedule(guild_id, white_list, session_id)
+        elif op in ("import", "reload"):
+            self.schedule_all(guild_id, white_list)
+
+    def touch_resolution(self, user: User) -> int:
+        # Activity must be recorded well within the TTL, or active members
+        # expire between two recorded touches
+        ttl = user.session_ttl if user.session_ttl is not None else self.default_ttl
+        if not ttl or ttl <= 0:
+            return SESSION_TOUCH_RESOLUTION
+        return min(SESSION_TOUCH_RESOLUTION, ttl // 2)
+
+    def deadline(self, white_list: Whitelist, session_id: int) -> float | None:
+        username = white_list.get_session(session_id)
+        if username is None:
+            return None
+        user = white_list.get_user(username)
+        ttl = user.session_ttl if user.session_ttl is not None else self.default_ttl
+        if not ttl or ttl <= 0:
+            return None
+        return user.get_session_times(session_id)[1] + ttl
+
+    def schedule(self, guild_id: int, white_list: Whitelist, session_id: int):
+        deadline = self.deadline(white_list, session_id)
+        if deadline is None:
+            return
+        key = (guild_id, session_id)
+        # A later deadline is found when the earlier entry comes up
+        scheduled = self.__deadlines.get(key, None)
+        if scheduled is not None and scheduled <= deadline:
+            return
+        self.__push(deadline, guild_id, session_id)
+
+    def __push(self, deadline: float, guild_id: int, session_id: int):
+        self.__deadlines[(guild_id, session_id)] = deadline
+        heapq.heappush(self.__heap, (deadline, guild_id, session_id))
+        if self.__heap[0][0] == deadline:
+            self.__wakeup.set()
+
+    def expire_due(self, now: float, limit: int = EXPIRY_BATCH) -> int:
+        expired = 0
+        while self.__heap and self.__heap[0][0] <= now and expired < limit:
+            deadline, guild_id, session_id = heapq.heappop(self.__heap)
+            key = (guild_id, session_id)
+            if self.__deadlines.get(key, None) != deadline:
+                continue
+            del self.__deadlines[key]
+            # Sessions of unloaded stores are scheduled again on load
+            store = self.__stores.peek(guild_id)
+            if store is None:
+                continue
+            white_list = store.get_whitelist()
+            actual = self.deadline(white_list, session_id)
+            if actual is None:
+                continue
+            if actual > now:
+                self.__push(actual, guild_id, session_id)
+                continue
+            user = white_list.get_user(white_list.get_session(session_id))
+            user.drop_session(session_id)
+            expired += 1
+            try:
+                self.__on_expired(guild_id, session_id, user)
+            except Exception as e:
+                log.error(f"Could not clean up expired session {session_id}: {e}")
+        return expired
+
+    async def run(self):
+        while 1:
+            self.__wakeup.clear()
+            expired = self.expire_due(time.time())
+            if expired:
+                log.info(f"Expired {expired} sessions")
+            if expired >= EXPIRY_BATCH:
+                await asyncio.sleep(0)
+                continue
+            timeout = self.__heap[0][0] - time.time() if self.__heap else None
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
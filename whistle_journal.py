@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Iterator, List
+
+# Group commit window (seconds) and the journal size that triggers compaction
+JOURNAL_COMMIT_DELAY = 0.05
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+
+
+def repair_tail(file_path: str) -> int:
+    # Cuts off a torn tail left by a crash, so new lines are not appended
+    # behind one that readers stop at. Returns the size of what is left.
+    if not os.path.exists(file_path):
+        return 0
+    valid = 0
+    with open(file_path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            valid += len(line)
+        torn = file.seek(0, os.SEEK_END) != valid
+    if torn:
+        with open(file_path, "r+b") as file:
+            file.truncate(valid)
+            file.flush()
+            os.fsync(file.fileno())
+    return valid
+
+
+class wlGroupCommit:
+    # Appends are buffered and handed to `write` together shortly after, off
+    # the event loop, so a burst of changes shares a single disk flush. The
+    # lock is held while a batch is written.
+    lock: asyncio.Lock
+    __write: Callable[[List], None]
+    __commit_delay: float
+    __executor: Executor | None
+    __pending: List
+    __flusher: asyncio.Task | None
+
+    def __init__(
+        self,
+        write: Callable[[List], None],
+        commit_delay: float = JOURNAL_COMMIT_DELAY,
+        executor: Executor | None = None,
+    ):
+        self.lock = asyncio.Lock()
+        self.__write = write
+        self.__commit_delay = commit_delay
+        self.__executor = executor
+        self.__pending = []
+        self.__flusher = None
+
+    def append(self, item: Any):
+        self.__pending.append(item)
+        if self.__flusher is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.__flusher = loop.create_task(self.__delayed_flush())
+
+    async def __delayed_flush(self):
+        await asyncio.sleep(self.__commit_delay)
+        self.__flusher = None
+        await self.flush()
+
+    def take(self) -> List:
+        # The buffered items, for callers that write them on their own
+        items, self.__pending = self.__pending, []
+        return items
+
+    async def run(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, function, *args
+        )
+
+    async def flush(self):
+        async with self.lock:
+            items = self.take()
+            if items:
+                await self.run(self.__write, items)
+
+    def flush_sync(self):
+        # For shutdown, outside of the event loop
+        items = self.take()
+        if not items:
+            return
+        if self.__executor is None:
+            self.__write(items)
+        else:
+            self.__executor.submit(self.__write, items).result()
+
+
+class wlJournal:
+    size: int
+    __file_path: str
+    __commit: wlGroupCommit
+
+    def __init__(self, file_path: str, commit_delay: float = JOURNAL_COMMIT_DELAY):
+        self.__file_path = file_path
+        self.__commit = wlGroupCommit(self.__write, commit_delay)
+        self.size = repair_tail(file_path)
+
+    def append(self, record: Dict):
+        self.__commit.append(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def flush(self):
+        await self.__commit.flush()
+
+    async def truncate(self, revision: int):
+        async with self.__commit.lock:
+            lines = self.__commit.take()
+            await self.__commit.run(self.__truncate, lines, revision)
+
+    def __write(self, lines: List[str]):
+        data = "".join(lines).encode("utf-8")
+        with open(self.__file_path, "ab") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        self.size += len(data)
+
+    def __truncate(self, lines: List[str], revision: int):
+        # Drops every record already folded into the snapshot at `revision`
+        if lines:
+            self.__write(lines)
+        kept = [
+            json.dumps(record, separators=(",", ":")) + "\n"
+            for record in self.read(self.__file_path)
+            if record["rev"] > revision
+        ]
+        data = "".join(kept).encode("utf-8")
+        temp_path = self.__file_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.__file_path)
+        self.size = len(data)
+
+    @staticmethod
+    def read(file_path: str) -> Iterator[Dict]:
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn write at the tail from a crash, nothing after it
+                    # was ever acknowledged.
+                    return
+                yield record
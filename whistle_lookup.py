@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from whistle_metrics import metrics
+from whistle_store import Whitelist, normalize_username, wlStores
+
+log = logging.getLogger(__name__)
+
+# Keep-alive connections idle for longer than this (seconds) are closed
+LOOKUP_IDLE_TIMEOUT = 30.0
+# Usernames plus session ids a single request may ask for
+LOOKUP_MAX_KEYS = 1000
+LOOKUP_MAX_BODY = 64 * 1024
+
+STATUS_LINES = {
+    200: b"200 OK",
+    304: b"304 Not Modified",
+    400: b"400 Bad Request",
+    404: b"404 Not Found",
+    405: b"405 Method Not Allowed",
+    413: b"413 Payload Too Large",
+    500: b"500 Internal Server Error",
+}
+
+
+class wlLookupServer:
+    # Answers read-only whitelist queries over HTTP/1.1, on localhost or on a
+    # unix socket:
+    #   GET  /guilds/<guild id>/lookup?user=<username>&session=<member id>
+    #   POST /guilds/<guild id>/lookup  {"users": [...], "sessions": [...]}
+    # Both keys can be repeated to batch lookups. The whitelist revision is
+    # the ETag, so pollers sending If-None-Match get an empty 304 until
+    # something changes. Connections are kept alive unless the client asks
+    # otherwise.
+    __stores: wlStores
+    __host: str
+    __port: int
+    __socket_path: str | None
+    __server: asyncio.AbstractServer | None
+
+    def __init__(
+        self,
+        stores: wlStores,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        socket_path: str | None = None,
+    ):
+        self.__stores = stores
+        self.__host = host
+        self.__port = port
+        self.__socket_path = socket_path
+        self.__server = None
+
+    async def start(self):
+        if self.__socket_path:
+            self.__server = await asyncio.start_unix_server(
+                self.__handle, self.__socket_path
+            )
+        else:
+            self.__server = await asyncio.start_server(
+                self.__handle, self.__host, self.__port
+            )
+
+    async def close(self):
+        if self.__server is None:
+            return
+        self.__server.close()
+        await self.__server.wait_closed()
+        self.__server = None
+        if self.__socket_path and os.path.exists(self.__socket_path):
+            os.remove(self.__socket_path)
+
+    async def __handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while 1:
+                head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"), LOOKUP_IDLE_TIMEOUT
+                )
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, version = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", None) or 0)
+                if length > LOOKUP_MAX_BODY:
+                    payload = {"error": "Request too large"}
+                    self.__respond(writer, 413, payload, None, False)
+                    await writer.drain()
+                    return
+                body = b""
+                if length:
+                    body = await asyncio.wait_for(
+                        reader.readexactly(length), LOOKUP_IDLE_TIMEOUT
+                    )
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+                try:
+                    status, payload, etag = await self.lookup(
+                        method, target, body, headers.get("if-none-match", None)
+                    )
+                except Exception as e:
+                    log.error(f"Lookup {method} {target} failed: {e}")
+                    status, payload, etag = 500, {"error": "Lookup failed"}, None
+                metrics.counter(
+                    "whistle_lookup_requests_total",
+                    "Lookup service requests by status",
+                    status=status,
+                ).inc()
+                self.__respond(writer, status, payload, etag, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def __respond(
+        writer: asyncio.StreamWriter,
+        status: int,
+        payload: Dict | None,
+        etag: str | None,
+        keep_alive: bool,
+    ):
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        head = [b"HTTP/1.1 " + STATUS_LINES[status]]
+        if payload is not None:
+            head.append(b"Content-Type: application/json")
+        if etag is not None:
+            head.append(b"ETag: " + etag.encode())
+        head.append(b"Content-Length: " + str(len(body)).encode())
+        connection = b"keep-alive" if keep_alive else b"close"
+        head.append(b"Connection: " + connection)
+        writer.write(b"\r\n".join(head) + b"\r\n\r\n" + body)
+
+    async def lookup(
+        self, method: str, target: str, body: bytes, if_none_match: str | None
+    ) -> Tuple[int, Dict | None, str | None]:
+        # Returns (status, JSON payload, ETag)
+        url = urlsplit(target)
+        parts = url.path.strip("/").split("/")
+        if (
+            len(parts) != 3
+            or parts[0] != "guilds"
+            or not parts[1].isdigit()
+            or parts[2] != "lookup"
+        ):
+            return 404, {"error": "Not found"}, None
+        if method == "GET":
+            query = parse_qs(url.query)
+            usernames = query.get("user", [])
+            session_ids = query.get("session", [])
+        elif method == "POST":
+            try:
+                request = json.loads(body)
+            except ValueError:
+                return 400, {"error": "Request body is not JSON"}, None
+            if not isinstance(request, dict):
+                return 400, {"error": "Request body must be an object"}, None
+            usernames = request.get("users", [])
+            session_ids = request.get("sessions", [])
+        else:
+            return 405, {"error": "Only GET and POST are supported"}, None
+        if not isinstance(usernames, list) or not isinstance(session_ids, list):
+            return 400, {"error": "users and sessions must be lists"}, None
+        if len(usernames) + len(session_ids) > LOOKUP_MAX_KEYS:
+            return 400, {"error": f"At most {LOOKUP_MAX_KEYS} keys per request"}, None
+        try:
+            session_ids = [int(session_id) for session_id in session_ids]
+        except (TypeError, ValueError):
+            return 400, {"error": "Session ids must be integers"}, None
+        guild_id = int(parts[1])
+        # Unknown guilds must not get an empty store created for them
+        if not self.__stores.exists(guild_id):
+            return 404, {"error": f"No whitelist for guild {guild_id}"}, None
+        white_list = await self.__stores.get_whitelist(guild_id)
+        # Nothing below awaits, so the answer is a single revision
+        etag = f'"{white_list.revision}"'
+        if method == "GET" and if_none_match == etag:
+            return 304, None, etag
+        payload = {
+            "revision": white_list.revision,
+            "users": {
+                str(username): self.describe_user(white_list, str(username))
+                for username in usernames
+            },
+            "sessions": {
+                str(session_id): white_list.get_session(session_id)
+                for session_id in session_ids
+            },
+        }
+        return 200, payload, etag
+
+    @staticmethod
+    def describe_user(white_list: Whitelist, username: str) -> Dict | None:
+        user = white_list.get_user(normalize_username(username))
+        if user is None:
+            return None
+        state = user.freeze()
+        return {
+            "username": user.username,
+            "pretty": state.pretty,
+            "session_limit": state.session_limit,
+            "session_ttl": state.session_ttl,
+            "sessions": list(state.sessions),
+            "roles": list(state.roles),
+        }
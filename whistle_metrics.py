@@ -0,0 +1,234 @@
+import asyncio
+import contextvars
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+import aiohttp
+
+# Upper bounds (seconds or bytes) of the histogram buckets
+COMMAND_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3, 1e-2)
+SAVE_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(1024 * 4**exponent for exponent in range(10))
+
+METRICS_READ_TIMEOUT = 5.0
+
+
+class wlCounter:
+    value: float
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class wlHistogram:
+    buckets: Tuple[float, ...]
+    counts: list
+    count: int
+    sum: float
+    max: float
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # The last slot counts everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        # Estimated as the upper bound of the bucket the quantile falls in
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class wlMetrics:
+    # name -> (type, help, buckets, {labels: metric})
+    __families: Dict[str, Tuple[str, str, Tuple[float, ...] | None, Dict]]
+
+    def __init__(self):
+        self.__families = {}
+
+    def __family(
+        self, name: str, kind: str, help: str, buckets: Tuple[float, ...] | None
+    ) -> Dict:
+        family = self.__families.get(name, None)
+        if family is None:
+            family = self.__families[name] = (kind, help, buckets, {})
+        elif family[0] != kind:
+            raise Exception(f"Metric {name} is already registered as a {family[0]}")
+        return family[3]
+
+    def counter(self, name: str, help: str, **labels) -> wlCounter:
+        metrics = self.__family(name, "counter", help, None)
+        key = tuple(sorted(labels.items()))
+        counter = metrics.get(key, None)
+        if counter is None:
+            counter = metrics[key] = wlCounter()
+        return counter
+
+    def histogram(
+        self, name: str, help: str, buckets: Tuple[float, ...], **labels
+    ) -> wlHistogram:
+        metrics = self.__family(name, "histogram", help, buckets)
+        key = tuple(sorted(labels.items()))
+        histogram = metrics.get(key, None)
+        if histogram is None:
+            histogram = metrics[key] = wlHistogram(self.__families[name][2])
+        return histogram
+
+    def family(self, name: str) -> Dict[Tuple, wlCounter | wlHistogram]:
+        family = self.__families.get(name, None)
+        return {} if family is None else dict(family[3])
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, (kind, help, buckets, metrics) in self.__families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics.items():
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(labels)} {metric.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, metric.counts):
+                    cumulative += count
+                    bucket = format_labels(labels + (("le", repr(float(bound))),))
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                bucket = format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{bucket} {metric.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = wlMetrics()
+
+# The Discord route of the request the current task is sending
+current_route: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_route", default="other"
+)
+
+
+def instrument_http(http):
+    # Tags every discord.py request with its route template for route_trace
+    request = http.request
+
+    async def route_request(route, **kwargs):
+        token = current_route.set(route.key)
+        try:
+            return await request(route, **kwargs)
+        finally:
+            current_route.reset(token)
+
+    http.request = route_request
+
+
+def route_trace() -> aiohttp.TraceConfig:
+    # Counts every response (retries included) by the route being sent
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_end(session, context, params):
+        route = current_route.get()
+        metrics.counter(
+            "whistle_discord_requests_total",
+            "Requests sent to the Discord API",
+            route=route,
+        ).inc()
+        if params.response.status == 429:
+            metrics.counter(
+                "whistle_discord_rate_limited_total",
+                "Discord API responses with status 429",
+                route=route,
+            ).inc()
+
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+class wlMetricsServer:
+    # Serves the Prometheus text format on GET /metrics, nothing else
+    __host: str
+    __port: int
+    __server: asyncio.AbstractServer | None
+
+    def __init__(self, host: str, port: int):
+        self.__host = host
+        self.__port = port
+        self.__server = None
+
+    async def start(self):
+        self.__server = await asyncio.start_server(
+            self.__handle, self.__host, self.__port
+        )
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    async def __handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), METRICS_READ_TIMEOUT
+            )
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?", 1)[0] == b"/metrics":
+                status = b"200 OK"
+                body = metrics.render_prometheus().encode("utf-8")
+            else:
+                status = b"404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                b"HTTP/1.1 "
+                + status
+                + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8"
+                + b"\r\nContent-Length: "
+                + str(len(body)).encode()
+                + b"\r\nConnection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        finally:
+            writer.close()
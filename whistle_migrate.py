@@ -0,0 +1,46 @@
+import argparse
+
+from whistle_backend import SNAPSHOT_FORMATS, wlSnapshotBackend, wlSqliteBackend
+from whistle_store import wlStore
+
+
+def migrate_json_to_sqlite(json_path: str, sqlite_path: str):
+    # Loading through wlStore replays any journaled changes first
+    data = wlStore(json_path, "json").jsonify()
+    wlSqliteBackend(sqlite_path).replace_all(data)
+    return data
+
+
+def convert_snapshot(source_path: str, destination_path: str, snapshot_format: str):
+    # The source format is detected on load, the journal is folded in
+    data = wlStore(source_path, "json").jsonify()
+    wlSnapshotBackend.save_store(destination_path, data, snapshot_format)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts data stores.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sqlite = commands.add_parser(
+        "sqlite", help="Imports an existing JSON or msgpack store into a SQLite store"
+    )
+    sqlite.add_argument("source", help="Path of the snapshot store, e.g. store.json")
+    sqlite.add_argument("destination", help="Path of the SQLite store, e.g. store.db")
+    convert = commands.add_parser(
+        "convert", help="Rewrites a snapshot store as JSON or msgpack"
+    )
+    convert.add_argument("source", help="Path of the snapshot store to read")
+    convert.add_argument("destination", help="Path of the snapshot store to write")
+    convert.add_argument("--format", choices=SNAPSHOT_FORMATS, default="json")
+    args = parser.parse_args()
+    if args.command == "sqlite":
+        data = migrate_json_to_sqlite(args.source, args.destination)
+    else:
+        data = convert_snapshot(args.source, args.destination, args.format)
+    print(
+        f"Wrote {len(data['whitelist'])} users at revision {data['revision']} to {args.destination}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,96 +1,688 @@
 import datetime
-import json
+import heapq
+import logging
 import os
-from typing import Dict, List
+import sys
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, NamedTuple, Set, Tuple
 import asyncio
-from hashlib import sha256
 
-WLSTORE_FILENAME = "store.json"
+from whistle_backend import (
+    BACKEND_EXTENSIONS,
+    SNAPSHOT_FORMATS,
+    create_backend,
+    wlBackend,
+    wlSnapshotBackend,
+    wlSqliteBackend,
+)
+from whistle_metrics import LOOKUP_BUCKETS, SAVE_BUCKETS, SIZE_BUCKETS, metrics
 
-INITIAL_DATA = {
-    "whitelist": {
-        "example_user": {
-            "pretty": "Example User",
-            "session_limit": 0,
-            "sessions": [],
-            "roles": [],
+log = logging.getLogger(__name__)
+
+# Autosaver timing (seconds)
+AUTOSAVE_DEBOUNCE = 5
+AUTOSAVE_MAX_DELAY = 120
+AUTOSAVE_MIN_INTERVAL = 5
+AUTOSAVE_MAX_INTERVAL = 120
+
+# Session activity closer together than this (seconds) is not recorded, or
+# half the session TTL if that is shorter
+SESSION_TOUCH_RESOLUTION = 300
+
+# Username suggestions: candidates are gathered from the rarest trigrams of
+# the query until there are this many, and must share at least this fraction
+# of their trigrams with it.
+SUGGESTION_CANDIDATES = 500
+SUGGESTION_MIN_SIMILARITY = 0.3
+# Usernames added to the trigram index before yielding to the event loop
+TRIGRAM_INDEX_CHUNK = 2000
+
+# Seconds a guild's store may go unused before it is saved and unloaded
+STORE_IDLE_TIMEOUT = 1800
+STORE_SWEEP_INTERVAL = 60
+
+# Plain lookups are a dict access, timing them would cost more than they do
+GET_SESSION_TOTAL = metrics.counter(
+    "whistle_store_lookups_total", "Whitelist lookups", op="get_session"
+)
+GET_USER_TOTAL = metrics.counter(
+    "whistle_store_lookups_total", "Whitelist lookups", op="get_user"
+)
+FIND_USERNAMES_SECONDS = metrics.histogram(
+    "whistle_store_lookup_seconds",
+    "Whitelist lookup duration",
+    LOOKUP_BUCKETS,
+    op="find_usernames",
+)
+SUGGEST_USERNAMES_SECONDS = metrics.histogram(
+    "whistle_store_lookup_seconds",
+    "Whitelist lookup duration",
+    LOOKUP_BUCKETS,
+    op="suggest_usernames",
+)
+AUTOSAVE_SECONDS = metrics.histogram(
+    "whistle_autosave_seconds", "Autosave duration", SAVE_BUCKETS
+)
+AUTOSAVE_BYTES = metrics.histogram(
+    "whistle_autosave_bytes", "Snapshot size written by the autosaver", SIZE_BUCKETS
+)
+
+
+def normalize_username(username: str) -> str:
+    # Usernames are stored and looked up lowercase and without spaces
+    return username.lower().replace(" ", "")
+
+
+def username_trigrams(username: str) -> Set[str]:
+    # Padded, so the first and last letters count as much as the others
+    padded = f"${username}$"
+    return {padded[index : index + 3] for index in range(len(padded) - 2)}
+
+
+class UserState(NamedTuple):
+    # A frozen copy of a user. It shares the user's strings and tuples, so
+    # taking one only costs the tuple itself.
+    pretty: str
+    session_limit: int
+    session_ttl: int | None
+    sessions: Tuple[int, ...]
+    created: Tuple[int, ...]
+    active: Tuple[int, ...]
+    roles: Tuple[int, ...]
+
+    def jsonify(self) -> Dict:
+        return {
+            "pretty": self.pretty,
+            "roles": list(self.roles),
+            "session_limit": self.session_limit,
+            "session_times": [
+                [created, active] for created, active in zip(self.created, self.active)
+            ],
+            "session_ttl": self.session_ttl,
+            "sessions": list(self.sessions),
         }
-    }
-}
 
 
 class User:
+    # Slots and tuples keep a user down to a handful of small objects. Users
+    # without sessions all share the empty tuple, and users linked to the
+    # same roles share a single tuple of role ids (see Whitelist). Session
+    # creation and last activity times (unix seconds) run parallel to the
+    # session ids.
+    __slots__ = (
+        "username",
+        "__pretty",
+        "__session_limit",
+        "__session_ttl",
+        "__sessions",
+        "__created",
+        "__active",
+        "__roles",
+        "__whitelist",
+    )
     username: str
-    pretty: str
-    roles: List[int]
+    __pretty: str
     __session_limit: int
-    __sessions: List[int]
+    __session_ttl: int | None
+    __sessions: Tuple[int, ...]
+    __created: Tuple[int, ...]
+    __active: Tuple[int, ...]
+    __roles: Tuple[int, ...]
+    __whitelist: "Whitelist"
 
-    def __init__(self, username: str, data: Dict):
-        self.username = username
-        self.pretty = data.get("pretty", username)
-        self.roles = data.get("roles", [])
+    def __init__(self, username: str, data: Dict, whitelist: "Whitelist" = None):
+        self.username = sys.intern(username)
+        pretty = data.get("pretty", username)
+        self.__pretty = self.username if pretty == username else pretty
         self.__session_limit = data.get("session_limit", 1)
-        self.__sessions = data.get("sessions", [])
+        self.__session_ttl = data.get("session_ttl", None)
+        self.__sessions = tuple(data.get("sessions", ()))
+        times = data.get("session_times", ())
+        if len(times) != len(self.__sessions):
+            # Sessions stored without times start their clock now
+            now = int(time.time())
+            times = [(now, now)] * len(self.__sessions)
+        self.__created = tuple(created for created, _ in times)
+        self.__active = tuple(active for _, active in times)
+        self.__whitelist = whitelist
+        self.__roles = self.__share_roles(data.get("roles", ()))
+
+    def __changed(self, op: str, **fields):
+        if self.__whitelist is not None:
+            self.__whitelist._changed(op, self.username, **fields)
+
+    def __preserve(self):
+        # Every change calls this before touching any field
+        if self.__whitelist is not None:
+            self.__whitelist._preserve(self.username)
+
+    def __share_roles(self, roles) -> Tuple[int, ...]:
+        if self.__whitelist is None:
+            return tuple(roles)
+        return self.__whitelist._share_roles(tuple(roles))
+
+    @property
+    def pretty(self) -> str:
+        return self.__pretty
+
+    @pretty.setter
+    def pretty(self, pretty: str):
+        self.__preserve()
+        self.__pretty = pretty
+        self.__changed("pretty", pretty=pretty)
+
+    @property
+    def roles(self) -> Tuple[int, ...]:
+        return self.__roles
+
+    @property
+    def session_ttl(self) -> int | None:
+        # Seconds a session may go without activity, None for the global TTL
+        return self.__session_ttl
+
+    @session_ttl.setter
+    def session_ttl(self, ttl: int | None):
+        self.__preserve()
+        self.__session_ttl = ttl
+        self.__changed("ttl", ttl=ttl)
+
+    def freeze(self) -> UserState:
+        return UserState(
+            self.__pretty,
+            self.__session_limit,
+            self.__session_ttl,
+            self.__sessions,
+            self.__created,
+            self.__active,
+            self.__roles,
+        )
 
     def jsonify(self) -> Dict:
-        return {
-            "pretty": self.pretty,
-            "roles": self.roles,
-            "session_limit": self.__session_limit,
-            "sessions": self.__sessions,
-        }
+        return self.freeze().jsonify()
 
-    def create_session(self, session_id: int):
+    def create_session(self, session_id: int, at: int | None = None):
         if session_id in self.__sessions:
             return
         if (len(self.__sessions) + 1) > self.__session_limit:
             raise Exception(
                 f"Session limit reached - Cannot create session {session_id}"
             )
-        self.__sessions.append(session_id)
+        at = int(time.time()) if at is None else at
+        self.__preserve()
+        self.__sessions += (session_id,)
+        self.__created += (at,)
+        self.__active += (at,)
+        if self.__whitelist is not None:
+            self.__whitelist._sessions_changed(self.username, [session_id], [])
+        self.__changed("login", session=session_id, at=at)
 
     def drop_session(self, session_id: int):
-        try:
-            self.__sessions.remove(session_id)
-        except ValueError:
+        if session_id not in self.__sessions:
             return
+        index = self.__sessions.index(session_id)
+        self.__preserve()
+        self.__sessions = self.__sessions[:index] + self.__sessions[index + 1 :]
+        self.__created = self.__created[:index] + self.__created[index + 1 :]
+        self.__active = self.__active[:index] + self.__active[index + 1 :]
+        if self.__whitelist is not None:
+            self.__whitelist._sessions_changed(self.username, [], [session_id])
+        self.__changed("logout", session=session_id)
+
+    def touch_session(
+        self,
+        session_id: int,
+        at: int | None = None,
+        resolution: int = SESSION_TOUCH_RESOLUTION,
+    ) -> bool:
+        # Records activity at most once per resolution, so busy members do
+        # not flood the journal.
+        if session_id not in self.__sessions:
+            return False
+        index = self.__sessions.index(session_id)
+        at = int(time.time()) if at is None else at
+        if at - self.__active[index] < resolution:
+            return False
+        self.__preserve()
+        self.__active = self.__active[:index] + (at,) + self.__active[index + 1 :]
+        self.__changed("touch", session=session_id, at=at)
+        return True
+
+    def get_session_times(self, session_id: int) -> Tuple[int, int] | None:
+        # (created, last active) in unix seconds
+        if session_id not in self.__sessions:
+            return None
+        index = self.__sessions.index(session_id)
+        return self.__created[index], self.__active[index]
 
     def list_sessions(self) -> List[int]:
-        return self.__sessions
+        return list(self.__sessions)
 
     def drop_all_sessions(self):
-        self.__sessions = []
+        self.__preserve()
+        dropped, self.__sessions = self.__sessions, ()
+        self.__created = self.__active = ()
+        if self.__whitelist is not None:
+            self.__whitelist._sessions_changed(self.username, [], list(dropped))
+        self.__changed("logout_all")
 
     def get_session_limit(self) -> int:
         return self.__session_limit
 
     def set_session_limit(self, limit: int):
+        self.__preserve()
         self.__session_limit = limit
         if len(self.__sessions) > self.__session_limit:
+            dropped = list(self.__sessions[self.__session_limit :])
             self.__sessions = self.__sessions[0 : self.__session_limit]
+            self.__created = self.__created[0 : self.__session_limit]
+            self.__active = self.__active[0 : self.__session_limit]
+            if self.__whitelist is not None:
+                self.__whitelist._sessions_changed(self.username, [], dropped)
+        self.__changed("limit", limit=limit)
 
+    def link_role(self, role_id: int) -> bool:
+        if role_id in self.__roles:
+            return False
+        self.__preserve()
+        self.__roles = self.__share_roles(self.__roles + (role_id,))
+        if self.__whitelist is not None:
+            self.__whitelist._roles_changed(self.username, [role_id], [])
+        self.__changed("link", role=role_id)
+        return True
 
-class Whitelist:
-    __users: List[User]
+    def unlink_role(self, role_id: int) -> bool:
+        if role_id not in self.__roles:
+            return False
+        roles = list(self.__roles)
+        roles.remove(role_id)
+        self.__preserve()
+        self.__roles = self.__share_roles(roles)
+        if self.__whitelist is not None:
+            self.__whitelist._roles_changed(self.username, [], [role_id])
+        self.__changed("unlink", role=role_id)
+        return True
+
+
+class wlSnapshot:
+    # The whitelist as of `revision`, readable from any thread. Taking one is
+    # free: it reads the live users and the whitelist copies a user's old
+    # state into every open snapshot the first time that user changes (None
+    # for users that did not exist yet). A reader checks for such a copy
+    # *after* reading the live user, so a change racing with the read is
+    # always caught. Close it once done, until then changes keep copying.
+    revision: int
+    __whitelist: "Whitelist"
+    __users: Dict[str, User]
+    __before: Dict[str, UserState | None]
+
+    def __init__(self, whitelist: "Whitelist", users: Dict[str, User]):
+        self.revision = whitelist.revision
+        self.__whitelist = whitelist
+        self.__users = users
+        self.__before = {}
 
-    def __init__(self, data: Dict):
-        self.__users = {
-            username: User(username, user_data) for username, user_data in data.items()
+    def __enter__(self) -> "wlSnapshot":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.__whitelist._release(self)
+
+    def _preserve(self, username: str, state: UserState | None):
+        self.__before.setdefault(username, state)
+
+    def get(self, username: str) -> UserState | None:
+        user = self.__users.get(username, None)
+        state = user.freeze() if user is not None else None
+        return self.__before.get(username, state)
+
+    def items(self) -> Iterator[Tuple[str, UserState]]:
+        # Copying a dict does not release the GIL, so the copies are never
+        # torn by the event loop. Users removed before the copy of the live
+        # users were preserved before they went away.
+        users = self.__users.copy()
+        for username, user in users.items():
+            state = user.freeze()
+            state = self.__before.get(username, state)
+            if state is not None:
+                yield username, state
+        for username, state in self.__before.copy().items():
+            if state is not None and username not in users:
+                yield username, state
+
+    def count(self) -> Tuple[int, int]:
+        # (users, sessions)
+        users = sessions = 0
+        for _, state in self.items():
+            users += 1
+            sessions += len(state.sessions)
+        return users, sessions
+
+    def jsonify(self) -> Dict:
+        return {
+            "revision": self.revision,
+            "whitelist": {
+                username: state.jsonify() for username, state in self.items()
+            },
         }
 
+
+class Whitelist:
+    revision: int
+    listener: Callable[[Dict], None] | None
+    __users: Dict[str, User]
+    __sessions: Dict[int, str]
+    __usernames: List[str]
+    __usernames_by_sessions: Dict[int, List[str]]
+    __role_ids: Dict[int, int]
+    __role_sets: Dict[Tuple[int, ...], Tuple[int, ...]]
+    __role_users: Dict[int, Set[str]] | None
+    __trigram_users: Dict[str, Set[str]] | None
+    __trigram_indexer: asyncio.Task | None
+    __snapshots: List[wlSnapshot]
+
+    def __init__(self, data: Dict, revision: int = 0):
+        self.revision = revision
+        self.listener = None
+        self.__snapshots = []
+        self.__role_ids = {}
+        self.__role_sets = {}
+        self.__role_users = None
+        self.__trigram_users = None
+        self.__trigram_indexer = None
+        self.__users = {}
+        for username, user_data in data.items():
+            user = User(username, user_data, self)
+            self.__users[user.username] = user
+        self.rebuild_session_index()
+        self.rebuild_username_index()
+
+    def _share_roles(self, roles: Tuple[int, ...]) -> Tuple[int, ...]:
+        # A guild only has a handful of linked roles, so most users repeat
+        # the same few ids and role combinations.
+        shared = self.__role_sets.get(roles, None)
+        if shared is None:
+            shared = tuple(self.__role_ids.setdefault(role, role) for role in roles)
+            self.__role_sets[shared] = shared
+        return shared
+
+    def snapshot(self) -> wlSnapshot:
+        snapshot = wlSnapshot(self, self.__users)
+        self.__snapshots.append(snapshot)
+        return snapshot
+
+    def _release(self, snapshot: wlSnapshot):
+        if snapshot in self.__snapshots:
+            self.__snapshots.remove(snapshot)
+
+    def _preserve(self, username: str):
+        # Called before a user is changed, added or removed
+        if not self.__snapshots:
+            return
+        user = self.__users.get(username, None)
+        state = user.freeze() if user is not None else None
+        for snapshot in self.__snapshots:
+            snapshot._preserve(username, state)
+
+    def _changed(self, op: str, username: str | None, **fields):
+        self.revision += 1
+        if self.listener is not None:
+            self.listener({"rev": self.revision, "op": op, "user": username, **fields})
+
+    def apply(self, record: Dict):
+        # Replays a change record produced by `listener` without re-emitting it
+        listener, self.listener = self.listener, None
+        try:
+            op = record["op"]
+            username = record["user"]
+            if op == "add":
+                self.__add_user(username, record["data"])
+            elif op == "remove":
+                self.remove_user(username)
+            elif op == "import":
+                self.import_users(record["users"])
+            else:
+                user = self.__users[username]
+                if op == "login":
+                    user.create_session(record["session"], record.get("at", None))
+                elif op == "logout":
+                    user.drop_session(record["session"])
+                elif op == "touch":
+                    user.touch_session(record["session"], record["at"], 0)
+                elif op == "ttl":
+                    user.session_ttl = record["ttl"]
+                elif op == "logout_all":
+                    user.drop_all_sessions()
+                elif op == "limit":
+                    user.set_session_limit(record["limit"])
+                elif op == "pretty":
+                    user.pretty = record["pretty"]
+                elif op == "link":
+                    user.link_role(record["role"])
+                elif op == "unlink":
+                    user.unlink_role(record["role"])
+                else:
+                    raise Exception(f"Unknown change record operation {op}")
+            self.revision = record["rev"]
+        finally:
+            self.listener = listener
+
     def jsonify(self) -> Dict:
         return {
             username: user_obj.jsonify() for username, user_obj in self.__users.items()
         }
 
-    def get_session(self, session_id: int) -> User | None:
+    def rebuild_session_index(self):
+        self.__sessions = {}
+        for user in self.__users.values():
+            for session_id in user.list_sessions():
+                self.__sessions[session_id] = user.username
+
+    def check_session_index(self) -> List[str]:
+        problems = []
+        scanned = {}
         for user in self.__users.values():
-            if session_id in user.list_sessions():
-                return user.username
-        return None
+            for session_id in user.list_sessions():
+                if session_id in scanned:
+                    problems.append(
+                        f"Session {session_id} is held by both {scanned[session_id]} and {user.username}"
+                    )
+                scanned[session_id] = user.username
+        for session_id, username in scanned.items():
+            indexed = self.__sessions.get(session_id, None)
+            if indexed != username:
+                problems.append(
+                    f"Session {session_id} belongs to {username} but is indexed as {indexed}"
+                )
+        for session_id in self.__sessions.keys() - scanned.keys():
+            problems.append(
+                f"Session {session_id} is indexed as {self.__sessions[session_id]} but nobody holds it"
+            )
+        return problems
+
+    def rebuild_username_index(self):
+        self.__usernames = sorted(self.__users.keys())
+        self.__usernames_by_sessions = {}
+        for username in self.__usernames:
+            count = len(self.__users[username].list_sessions())
+            self.__usernames_by_sessions.setdefault(count, []).append(username)
+
+    def _index_session(self, session_id: int, username: str):
+        self.__sessions[session_id] = username
+
+    def _unindex_session(self, session_id: int, username: str):
+        if self.__sessions.get(session_id, None) == username:
+            del self.__sessions[session_id]
+
+    def users_with_role(self, role_id: int) -> List[str]:
+        # The role index is only needed when a role goes away, so it is built
+        # on first use and kept up to date from then on.
+        if self.__role_users is None:
+            self.__role_users = {}
+            for user in self.__users.values():
+                self._roles_changed(user.username, user.roles, [])
+        return sorted(self.__role_users.get(role_id, ()))
+
+    def _roles_changed(self, username: str, added: List[int], removed: List[int]):
+        if self.__role_users is None:
+            return
+        for role_id in removed:
+            usernames = self.__role_users.get(role_id, None)
+            if usernames is not None:
+                usernames.discard(username)
+                if not usernames:
+                    del self.__role_users[role_id]
+        for role_id in added:
+            self.__role_users.setdefault(role_id, set()).add(username)
+
+    async def suggest_usernames(self, username: str, limit: int) -> List[str]:
+        # The closest usernames by shared trigrams, for "did you mean"
+        await self.index_trigrams()
+        started = time.perf_counter()
+        grams = username_trigrams(normalize_username(username))
+        postings = sorted(
+            (self.__trigram_users.get(gram, ()) for gram in grams), key=len
+        )
+        # Rare trigrams pick the candidates, common ones only add to scores
+        shared = Counter()
+        scored = 0
+        for posting in postings:
+            if len(shared) + len(posting) > SUGGESTION_CANDIDATES:
+                if not shared:
+                    shared.update(islice(posting, SUGGESTION_CANDIDATES))
+                    scored += 1
+                break
+            shared.update(posting)
+            scored += 1
+        for posting in postings[scored:]:
+            shared.update(shared.keys() & posting)
+        # A username of n letters has about n trigrams. Closest first, ties
+        # by name.
+        closest = heapq.nsmallest(
+            limit,
+            (
+                (-count / (len(name) + len(grams) - count), name)
+                for name, count in shared.items()
+            ),
+        )
+        suggestions = [
+            name for score, name in closest if -score >= SUGGESTION_MIN_SIMILARITY
+        ]
+        SUGGEST_USERNAMES_SECONDS.observe(time.perf_counter() - started)
+        return suggestions
+
+    async def index_trigrams(self):
+        # Built on first use and kept up to date from then on, like the role
+        # index. Building happens in chunks so a large whitelist does not
+        # stall the event loop.
+        if self.__trigram_indexer is None:
+            self.__trigram_indexer = asyncio.get_running_loop().create_task(
+                self.__index_all_trigrams()
+            )
+        await asyncio.shield(self.__trigram_indexer)
+
+    async def __index_all_trigrams(self):
+        # Users added or removed from here on update the index themselves
+        self.__trigram_users = {}
+        usernames = list(self.__users.keys())
+        for start in range(0, len(usernames), TRIGRAM_INDEX_CHUNK):
+            for username in usernames[start : start + TRIGRAM_INDEX_CHUNK]:
+                if username in self.__users:
+                    self.__index_trigrams(username)
+            await asyncio.sleep(0)
+
+    def __index_trigrams(self, username: str):
+        for gram in username_trigrams(username):
+            self.__trigram_users.setdefault(gram, set()).add(username)
+
+    def __unindex_trigrams(self, username: str):
+        for gram in username_trigrams(username):
+            usernames = self.__trigram_users.get(gram, None)
+            if usernames is not None:
+                usernames.discard(username)
+                if not usernames:
+                    del self.__trigram_users[gram]
+
+    def list_session_ids(self) -> List[int]:
+        return list(self.__sessions.keys())
+
+    def _sessions_changed(self, username: str, added: List[int], removed: List[int]):
+        for session_id in removed:
+            self._unindex_session(session_id, username)
+        for session_id in added:
+            self._index_session(session_id, username)
+        count = len(self.__users[username].list_sessions())
+        previous = count - len(added) + len(removed)
+        if count != previous:
+            self.__unindex_username(username, previous)
+            self.__index_username(username, count)
+
+    def __index_username(self, username: str, count: int):
+        insort(self.__usernames_by_sessions.setdefault(count, []), username)
+
+    def __unindex_username(self, username: str, count: int):
+        bucket = self.__usernames_by_sessions[count]
+        del bucket[bisect_left(bucket, username)]
+        if not bucket:
+            del self.__usernames_by_sessions[count]
+
+    @staticmethod
+    def __prefix_range(usernames: List[str], prefix: str) -> Tuple[int, int]:
+        if not prefix:
+            return 0, len(usernames)
+        return (
+            bisect_left(usernames, prefix),
+            bisect_left(usernames, prefix + "\U0010ffff"),
+        )
+
+    def find_usernames(self, prefix: str, limit: int) -> List[str]:
+        started = time.perf_counter()
+        usernames = self.page_usernames(0, limit, prefix)
+        FIND_USERNAMES_SECONDS.observe(time.perf_counter() - started)
+        return usernames
+
+    def count_users(self, prefix: str = "") -> int:
+        start, end = self.__prefix_range(self.__usernames, prefix)
+        return end - start
+
+    def page_usernames(
+        self,
+        offset: int,
+        limit: int,
+        prefix: str = "",
+        by_sessions: bool = False,
+    ) -> List[str]:
+        # Slices a page straight out of the sorted indexes, optionally
+        # ordered by session count (most sessions first) and then by name.
+        if not by_sessions:
+            start, end = self.__prefix_range(self.__usernames, prefix)
+            start = min(start + offset, end)
+            return self.__usernames[start : min(start + limit, end)]
+        page = []
+        for count in sorted(self.__usernames_by_sessions.keys(), reverse=True):
+            bucket = self.__usernames_by_sessions[count]
+            start, end = self.__prefix_range(bucket, prefix)
+            if offset >= end - start:
+                offset -= end - start
+                continue
+            start += offset
+            offset = 0
+            page.extend(bucket[start : min(start + limit - len(page), end)])
+            if len(page) >= limit:
+                break
+        return page
+
+    def get_session(self, session_id: int) -> str | None:
+        GET_SESSION_TOTAL.inc()
+        return self.__sessions.get(session_id, None)
 
     def get_user(self, username: str) -> User | None:
+        GET_USER_TOTAL.inc()
         return self.__users.get(username, None)
 
     def add_user(
@@ -101,7 +693,7 @@ class Whitelist:
         sessions: List[int] = [],
         roles: List[int] = [],
     ) -> None:
-        self.__users[username] = User(
+        user = self.__add_user(
             username,
             {
                 "pretty": pretty if pretty else username,
@@ -110,89 +702,474 @@ class Whitelist:
                 "roles": roles,
             },
         )
+        self._changed("add", username, data=user.jsonify())
 
-    def list_users(self) -> Dict:
-        return {username: user.jsonify() for username, user in self.__users.items()}
+    def __add_user(self, username: str, data: Dict) -> User:
+        self.__remove_user(username)
+        user = User(username, data, self)
+        username = user.username
+        self.__users[username] = user
+        for session_id in user.list_sessions():
+            self._index_session(session_id, username)
+        insort(self.__usernames, username)
+        self.__index_username(username, len(user.list_sessions()))
+        self._roles_changed(username, user.roles, [])
+        if self.__trigram_users is not None:
+            self.__index_trigrams(username)
+        return user
 
-    def get_users(self) -> List[User]:
+    def import_users(self, rows: List[Dict]):
+        # Replaces or adds every row as a single change
+        for row in rows:
+            self.__add_user(
+                row["username"],
+                {
+                    "pretty": row.get("pretty") or row["username"],
+                    "session_limit": row.get("session_limit", 1),
+                    "sessions": row.get("sessions", []),
+                    "roles": row.get("roles", []),
+                },
+            )
+        self._changed("import", None, users=rows)
+
+    def get_users(self) -> Dict[str, User]:
         return {username: user for username, user in self.__users.items()}
 
     def remove_user(self, username: str):
-        self.__users.pop(username, None)
+        if self.__remove_user(username) is not None:
+            self._changed("remove", username)
+
+    def __remove_user(self, username: str) -> User | None:
+        self._preserve(username)
+        user = self.__users.pop(username, None)
+        if user is None:
+            return None
+        for session_id in user.list_sessions():
+            self._unindex_session(session_id, username)
+        del self.__usernames[bisect_left(self.__usernames, username)]
+        self.__unindex_username(username, len(user.list_sessions()))
+        self._roles_changed(username, [], user.roles)
+        if self.__trigram_users is not None:
+            self.__unindex_trigrams(username)
+        return user
 
     def remove_all_users(self):
-        self.__users = []
+        for username in list(self.__users.keys()):
+            self.remove_user(username)
 
 
 class wlStore:
-    __file_path: str
+    __backend: wlBackend
+    __backend_name: str
     __data: Dict
+    __saved_revision: int
+    __save_lock: asyncio.Lock
+    __compactor: asyncio.Task | None
+    # Called with every change record after the backend, and with a "reload"
+    # record once the whitelist was replaced by a reload.
+    observers: List[Callable[[Dict], None]]
     last_update: datetime.datetime
     last_save: datetime.datetime
 
-    def __init__(self, file_name):
-        self.__file_path = file_name
+    def __init__(self, file_name, backend: str = "json"):
+        self.__backend = create_backend(backend, file_name)
+        self.__backend_name = backend
+        self.__save_lock = asyncio.Lock()
+        self.__compactor = None
+        self.observers = []
         self.load()
+        self.last_save = self.last_update
 
-    def reload(self):
-        self.save()
-        self.load()
+    async def reload_async(self):
+        # Changes keep coming in while the store saves and the backend loads,
+        # they are replayed on the loaded whitelist unless the load saw them
+        white_list = self.get_whitelist()
+        changes = []
+
+        def buffer(record: Dict):
+            changes.append(record)
+            self.__record(record)
 
-    def save(self):
-        self.save_store(self.__file_path, self.jsonify())
-        self.last_save = datetime.datetime.now()
+        white_list.listener = buffer
+        try:
+            await self.save_async()
+            # Buffered records must be in the files the backend loads from
+            await self.commit()
+            started = time.perf_counter()
+            json_data, records = await asyncio.to_thread(self.__backend.load)
+        finally:
+            white_list.listener = self.__record
+        replay = {record["rev"]: record for record in records + changes}
+        self.__set_data(json_data, [replay[rev] for rev in sorted(replay)])
+        self.__observe("whistle_store_load_seconds", "Store load duration", started)
+        self.__notify({"rev": self.revision, "op": "reload", "user": None})
+
+    async def save_async(self) -> int | None:
+        # Only one save runs at a time. Callers that queued up behind it
+        # return without writing if that save already covered their changes.
+        # Returns the size of the written snapshot, if there was one.
+        revision = self.revision
+        async with self.__save_lock:
+            if self.__saved_revision >= revision:
+                return None
+            started = time.perf_counter()
+            if self.__backend.incremental:
+                revision = self.revision
+                size = await self.__backend.save(None, revision)
+            else:
+                # Serialized off the loop, changes made meanwhile stay in the
+                # journal for the next save
+                with self.snapshot() as snapshot:
+                    revision = snapshot.revision
+                    size = await self.__backend.save(snapshot, revision)
+            self.__saved_revision = revision
+            self.last_save = datetime.datetime.now()
+            self.__observe("whistle_store_save_seconds", "Store save duration", started)
+            return size
 
     def load(self):
-        json_data = self.load_store(self.__file_path)
+        started = time.perf_counter()
+        self.__set_data(*self.__backend.load())
+        self.__observe("whistle_store_load_seconds", "Store load duration", started)
+
+    def __observe(self, name: str, help: str, started: float):
+        metrics.histogram(
+            name, help, SAVE_BUCKETS, backend=self.__backend_name
+        ).observe(time.perf_counter() - started)
+
+    def __set_data(self, json_data: Dict, records: List[Dict]):
+        # The snapshot is only as new as its revision, any change records
+        # the backend kept after it are replayed on top.
         self.__data = self.from_json(json_data)
+        white_list = self.__data.get("whitelist")
+        self.__saved_revision = white_list.revision
+        for record in records:
+            if record["rev"] > white_list.revision:
+                white_list.apply(record)
+        white_list.listener = self.__record
         self.last_update = datetime.datetime.now()
 
+    def __record(self, record: Dict):
+        self.__backend.record(record)
+        metrics.counter(
+            "whistle_store_changes_total",
+            "Whitelist changes by operation",
+            op=record["op"],
+        ).inc()
+        self.__notify(record)
+        if not self.__backend.needs_compaction():
+            return
+        if self.__compactor is not None and not self.__compactor.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.__compactor = loop.create_task(self.save_async())
+
+    def __notify(self, record: Dict):
+        for observer in self.observers:
+            observer(record)
+
+    async def commit(self):
+        await self.__backend.flush()
+
+    async def stop(self, autosaver: asyncio.Task):
+        # Cancelling the autosaver mid-save would leave its write running in
+        # a thread, so a save in flight is let finish first
+        async with self.__save_lock:
+            autosaver.cancel()
+        await asyncio.wait([autosaver])
+
+    async def close(self):
+        await self.save_async()
+        await self.commit()
+        await asyncio.to_thread(self.__backend.close)
+
+    @property
+    def revision(self) -> int:
+        return self.__data.get("whitelist").revision
+
+    def is_dirty(self) -> bool:
+        return self.revision != self.__saved_revision
+
     def jsonify(self):
-        return {"whitelist": self.__data.get("whitelist").jsonify()}
+        white_list = self.__data.get("whitelist")
+        return {"revision": white_list.revision, "whitelist": white_list.jsonify()}
 
     def get_whitelist(self) -> Whitelist | None:
         return self.__data.get("whitelist", None)
 
+    def snapshot(self) -> wlSnapshot:
+        return self.__data.get("whitelist").snapshot()
+
     @staticmethod
     def from_json(json_data: Dict) -> Dict:
-        return {"whitelist": Whitelist(json_data.get("whitelist"))}
+        return {
+            "whitelist": Whitelist(
+                json_data.get("whitelist"), json_data.get("revision", 0)
+            )
+        }
 
-    @staticmethod
-    def create_initial_store(file_path):
-        with open(file_path, "w", encoding="utf-8") as file:
-            json.dump(INITIAL_DATA, file)
+    async def autosaver(
+        self,
+        debounce: float = AUTOSAVE_DEBOUNCE,
+        max_delay: float = AUTOSAVE_MAX_DELAY,
+        min_interval: float = AUTOSAVE_MIN_INTERVAL,
+        max_interval: float = AUTOSAVE_MAX_INTERVAL,
+    ):
+        # Saves only when the revision moved. While changes keep coming in we
+        # wait for them to settle (but never longer than max_delay), and while
+        # nothing happens we check less and less often.
+        log.debug("Auto saver -- Loop initializing!")
+        interval = min_interval
+        seen_revision = self.revision
+        dirty_since = None
+        while 1:
+            await asyncio.sleep(interval)
+            if not self.is_dirty():
+                dirty_since = None
+                interval = min(interval * 2, max_interval)
+                continue
+            now = time.monotonic()
+            if dirty_since is None:
+                dirty_since = now
+            revision = self.revision
+            if revision != seen_revision and now - dirty_since < max_delay:
+                seen_revision = revision
+                interval = debounce
+                continue
+            started = time.perf_counter()
+            size = await self.save_async()
+            AUTOSAVE_SECONDS.observe(time.perf_counter() - started)
+            if size is not None:
+                AUTOSAVE_BYTES.observe(size)
+            dirty_since = None
+            interval = min_interval
+            log.info(f"Auto saver -- Saved revision {revision}!")
+
+
+class wlStores:
+    # One store per guild, loaded on first use and unloaded again once idle
+    __directory: str
+    __backend: str
+    __legacy_file: str | None
+    __legacy_guild: int | None
+    __idle_timeout: float
+    __stores: Dict[int, wlStore]
+    __loading: Dict[int, asyncio.Task]
+    __closing: Dict[int, asyncio.Task]
+    __autosavers: Dict[int, asyncio.Task]
+    __last_used: Dict[int, float]
+    # Called with (guild id, store) whenever a guild's store was loaded
+    on_load: List[Callable[[int, wlStore], None]]
+
+    def __init__(
+        self,
+        directory: str,
+        backend: str = "json",
+        legacy_file: str = None,
+        legacy_guild: int = None,
+        idle_timeout: float = STORE_IDLE_TIMEOUT,
+    ):
+        self.__directory = directory
+        self.__backend = backend
+        self.__legacy_file = legacy_file
+        self.__legacy_guild = legacy_guild
+        self.__idle_timeout = idle_timeout
+        self.__stores = {}
+        self.__loading = {}
+        self.__closing = {}
+        self.__autosavers = {}
+        self.__last_used = {}
+        self.on_load = []
+        os.makedirs(directory, exist_ok=True)
+        if legacy_file and legacy_guild is None and os.path.exists(legacy_file):
+            log.warning(
+                f"Data store {legacy_file} is not used, set wl_store_legacy_guild to the guild it belongs to"
+            )
+
+    def path(self, guild_id: int, backend: str = None) -> str:
+        extension = BACKEND_EXTENSIONS[backend or self.__backend]
+        return os.path.join(self.__directory, f"{guild_id}{extension}")
+
+    def __other_formats(self, guild_id: int) -> List[str]:
+        # Snapshot stores switch between JSON and msgpack without conversion,
+        # the format is detected on load and the next save writes the new one
+        if self.__backend not in SNAPSHOT_FORMATS:
+            return []
+        return [
+            self.path(guild_id, snapshot_format)
+            for snapshot_format in SNAPSHOT_FORMATS
+            if snapshot_format != self.__backend
+        ]
+
+    def loaded(self) -> Dict[int, wlStore]:
+        return dict(self.__stores)
+
+    def peek(self, guild_id: int) -> wlStore | None:
+        # The guild's store if it is loaded, without counting as a use
+        return self.__stores.get(guild_id, None)
+
+    def mark_used(self, guild_id: int):
+        # Keeps a loaded store from being unloaded as idle
+        if guild_id in self.__stores:
+            self.__last_used[guild_id] = time.monotonic()
+
+    def exists(self, guild_id: int) -> bool:
+        # Whether the guild has a store, without loading or creating one
+        return (
+            guild_id in self.__stores
+            or guild_id in self.__loading
+            or guild_id in self.__closing
+            or guild_id == self.__legacy_guild
+            or os.path.exists(self.path(guild_id))
+            or any(os.path.exists(path) for path in self.__other_formats(guild_id))
+        )
+
+    async def get(self, guild_id: int) -> wlStore:
+        self.__last_used[guild_id] = time.monotonic()
+        store = self.__stores.get(guild_id, None)
+        if store is not None:
+            return store
+        # Concurrent first uses of a guild share a single load
+        loading = self.__loading.get(guild_id, None)
+        if loading is None:
+            loading = asyncio.get_running_loop().create_task(self.__load(guild_id))
+            self.__loading[guild_id] = loading
+        return await asyncio.shield(loading)
+
+    async def get_whitelist(self, guild_id: int) -> Whitelist:
+        return (await self.get(guild_id)).get_whitelist()
+
+    async def __load(self, guild_id: int) -> wlStore:
+        try:
+            # A store still being unloaded has changes that are not on disk
+            closing = self.__closing.get(guild_id, None)
+            if closing is not None:
+                try:
+                    await asyncio.shield(closing)
+                except Exception as e:
+                    log.error(f"Closing the previous store of {guild_id} failed: {e}")
+            path = self.path(guild_id)
+            if guild_id == self.__legacy_guild:
+                await asyncio.to_thread(self.__adopt_legacy_store, path)
+            await asyncio.to_thread(
+                self.__adopt_other_format, path, self.__other_formats(guild_id)
+            )
+            store = await asyncio.to_thread(wlStore, path, self.__backend)
+            self.__stores[guild_id] = store
+            # Exactly one autosaver per loaded store
+            autosaver = self.__autosavers.get(guild_id, None)
+            if autosaver is None or autosaver.done():
+                self.__autosavers[guild_id] = asyncio.get_running_loop().create_task(
+                    store.autosaver(), name=f"wlStore Autosaver {guild_id}"
+                )
+            for on_load in self.on_load:
+                on_load(guild_id, store)
+            return store
+        finally:
+            del self.__loading[guild_id]
+
+    def __adopt_legacy_store(self, path: str):
+        # The store from before guild partitions becomes this guild's store
+        if not self.__legacy_file or os.path.exists(path):
+            return
+        if not os.path.exists(self.__legacy_file):
+            return
+        legacy_backend = (
+            "sqlite"
+            if self.__legacy_file.endswith(BACKEND_EXTENSIONS["sqlite"])
+            else "json"
+        )
+        if (legacy_backend == "sqlite") == (self.__backend == "sqlite"):
+            for suffix in ("", ".journal", "-wal", "-shm"):
+                if os.path.exists(self.__legacy_file + suffix):
+                    os.replace(self.__legacy_file + suffix, path + suffix)
+            log.info(f"Adopted legacy data store {self.__legacy_file} as {path}")
+            return
+        # A snapshot and a SQLite store cannot stand in for each other, the
+        # data is converted and the legacy files are kept aside
+        data = self.__read_store(self.__legacy_file, legacy_backend)
+        if self.__backend == "sqlite":
+            backend = wlSqliteBackend(path)
+            try:
+                backend.replace_all(data)
+            finally:
+                backend.close()
+        else:
+            wlSnapshotBackend.save_store(path, data, self.__backend)
+        for suffix in ("", ".journal", "-wal", "-shm"):
+            if os.path.exists(self.__legacy_file + suffix):
+                os.replace(
+                    self.__legacy_file + suffix,
+                    self.__legacy_file + suffix + ".migrated",
+                )
+        log.info(f"Migrated legacy data store {self.__legacy_file} into {path}")
 
     @staticmethod
-    def load_store(file_path):
-        if not os.path.exists(file_path):
-            wlStore.create_initial_store(file_path)
+    def __read_store(file_path: str, backend_name: str) -> Dict:
+        backend = create_backend(backend_name, file_path)
         try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            wlStore.create_initial_store(file_path)
-            return wlStore.load_store(file_path)
+            json_data, records = backend.load()
+        finally:
+            backend.close()
+        white_list = wlStore.from_json(json_data)["whitelist"]
+        for record in records:
+            if record["rev"] > white_list.revision:
+                white_list.apply(record)
+        return {"revision": white_list.revision, "whitelist": white_list.jsonify()}
+
+    @staticmethod
+    def __adopt_other_format(path: str, other_paths: List[str]):
+        if os.path.exists(path):
+            return
+        for other_path in other_paths:
+            if not os.path.exists(other_path):
+                continue
+            for suffix in ("", ".journal"):
+                if os.path.exists(other_path + suffix):
+                    os.replace(other_path + suffix, path + suffix)
+            log.info(f"Adopted data store {other_path} as {path}")
+            return
+
+    async def unload(self, guild_id: int):
+        store = self.__stores.pop(guild_id, None)
+        self.__last_used.pop(guild_id, None)
+        autosaver = self.__autosavers.pop(guild_id, None)
+        if store is None:
+            if autosaver is not None:
+                autosaver.cancel()
+            return
+        # Loads of the guild wait until everything was written
+        closing = asyncio.get_running_loop().create_task(
+            self.__close(store, autosaver)
+        )
+        self.__closing[guild_id] = closing
+        closing.add_done_callback(lambda task: self.__closed(guild_id, task))
+        await asyncio.shield(closing)
 
     @staticmethod
-    def save_store(file_path, data):
-        with open(file_path, "w", encoding="utf-8") as file:
-            json.dump(data, file)
-            file.flush()
-            file.close()
-
-    async def autosaver(self):
-        data_hash = lambda x: sha256(str(x).encode("utf-8")).hexdigest()
-        last_save_hash = None
-        print("Auto saver -- Loop initializing!")
+    async def __close(store: wlStore, autosaver: asyncio.Task | None):
+        if autosaver is not None:
+            await store.stop(autosaver)
+        await store.close()
+
+    def __closed(self, guild_id: int, task: asyncio.Task):
+        if self.__closing.get(guild_id, None) is task:
+            del self.__closing[guild_id]
+
+    async def unload_idle(self):
+        now = time.monotonic()
+        for guild_id in list(self.__stores.keys()):
+            if now - self.__last_used.get(guild_id, now) >= self.__idle_timeout:
+                await self.unload(guild_id)
+
+    async def unload_all(self):
+        for guild_id in list(self.__stores.keys()):
+            await self.unload(guild_id)
+
+    async def maintainer(self, interval: float = STORE_SWEEP_INTERVAL):
         while 1:
-            current_save_hash = data_hash(self.jsonify())
-            print(
-                f"Auto saver -- (Current) {current_save_hash}\n              (Last)    {last_save_hash}"
-            )
-            if current_save_hash != last_save_hash:
-                self.save()
-                last_save_hash = current_save_hash
-                print("Auto saver -- Saved!")
-            print("Auto saver -- Waiting for next itteration...")
-            await asyncio.sleep(120)
-        print("Auto saver -- Loop terminated!")
+            await asyncio.sleep(interval)
+            await self.unload_idle()